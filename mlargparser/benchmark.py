@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Benchmark suite for MLArgParser dispatch overhead at scale.
+#
+# Generates synthetic applications (wide, deep, and parameter-heavy command trees), then measures cold-start time
+# (a fresh interpreter per run, with and without the schema cache), in-process dispatch latency, help rendering time,
+# and peak memory.  Results are emitted as JSON so they can be compared across releases.
+
+# Standard Library
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# make sure the generated apps (and this script) use the mlargparser next to this file
+LIBRARY_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, LIBRARY_DIR)
+
+import mlargparser  # noqa: E402
+
+# types cycled through for the arguments of generated commands (and a matching literal for each)
+ARG_TYPES = [("int", "1"), ("str", "value"), ("float", "1.5"), ("list", "[1, 2]"), ("bool", None)]
+
+# the shapes of command tree to benchmark
+SCENARIOS = {
+    'wide': "1000 commands at one level",
+    'deep': "10 levels of sub-commands with 20 commands each",
+    'params': "20 commands with 50 typed arguments each",
+}
+
+
+def get_command_source(name, arg_count, indent):
+    # build the source of a (no-op) command method with arg_count typed arguments
+    pad = " " * indent
+    args = ["self", "name: str"]
+    
+    for index in range(1, arg_count):
+        type_name = ARG_TYPES[index % len(ARG_TYPES)][0]
+        default = "False" if type_name == "bool" else "None"
+        args.append("arg%02d: %s = %s" % (index, type_name, default))
+    
+    return "%sdef %s(%s):\n%s    \"\"\" %s does nothing, quickly \"\"\"\n%s    pass\n" % (
+        pad, name, ", ".join(args), pad, name, pad
+    )
+
+
+def get_level_source(depth, max_depth, command_count, arg_count, indent):
+    # build the body of a command class, nesting a "Sub" class until max_depth is reached
+    pad = " " * indent
+    body = [get_command_source("cmd%04d" % index, arg_count, indent) for index in range(command_count)]
+    
+    if depth < max_depth:
+        body.append("%sclass Sub(MLArgParser):\n%s    \"\"\" level %d commands \"\"\"\n\n%s" % (
+            pad, pad, depth + 1, get_level_source(depth + 1, max_depth, command_count, arg_count, indent + 4)
+        ))
+    
+    return "\n".join(body)
+
+
+def generate_app(scenario, directory):
+    # write the synthetic application for a scenario; returns its path and the argv which reaches a leaf command
+    if scenario == 'wide':
+        depth, command_count, arg_count = 1, 1000, 3
+    elif scenario == 'deep':
+        depth, command_count, arg_count = 10, 20, 3
+    else:
+        depth, command_count, arg_count = 1, 20, 50
+    
+    argv = ["sub"] * (depth - 1) + ["cmd%04d" % (command_count // 2), "--name", "x"]
+    
+    # give a handful of the typed arguments too, so type conversion is part of the measurement
+    for index in range(1, min(arg_count, 10)):
+        type_name, literal = ARG_TYPES[index % len(ARG_TYPES)]
+        argv += ["--arg%02d" % index] if literal is None else ["--arg%02d" % index, literal]
+    
+    source = "".join([
+        "import sys\n",
+        "sys.path.insert(0, %r)\n" % LIBRARY_DIR,
+        "from mlargparser import MLArgParser\n\n\n",
+        "class App(MLArgParser):\n",
+        "    \"\"\" synthetic %s benchmark app \"\"\"\n\n" % scenario,
+        get_level_source(1, depth, command_count, arg_count, 4),
+        "\n\nif __name__ == '__main__':\n    App()\n",
+    ])
+    
+    path = os.path.join(directory, "bench_%s.py" % scenario)
+    
+    with open(path, 'w') as app_file:
+        app_file.write(source)
+    
+    return path, argv
+
+
+def load_app(path):
+    # import a generated app under its own module name (so it can be referenced by the schema cache)
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module.App
+
+
+def summarize(samples):
+    return {'median': statistics.median(samples), 'min': min(samples), 'max': max(samples), 'runs': len(samples)}
+
+
+def measure_cold_start(path, argv, runs, env):
+    # time a fresh interpreter running the app from start to exit
+    samples = list()
+    
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, path] + argv, env=env, check=True, stdout=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - started)
+    
+    return summarize(samples)
+
+
+def measure_peak_rss(path, argv, env):
+    # run the app once more in a fresh interpreter which reports its own peak RSS (in KiB) on exit
+    if resource is None:
+        return None
+    
+    code = (
+        "import resource, runpy, sys\n"
+        "sys.argv = %r\n"
+        "runpy.run_path(%r, run_name='__main__')\n"
+        "sys.stderr.write('%%d\\n' %% resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)\n"
+    ) % ([path] + argv, path)
+    
+    result = subprocess.run([sys.executable, "-c", code], env=env, check=True, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    
+    return int(result.stderr.strip().splitlines()[-1])
+
+
+def measure_help(app, argv):
+    # time rendering a help page (including the "available commands" epilog where there is one)
+    started = time.perf_counter()
+    
+    try:
+        app.run(argv, prog="bench")
+    except mlargparser.HelpRequested as help_request:
+        help_text = help_request.help
+    
+    return time.perf_counter() - started, len(help_text)
+
+
+def measure_in_process(app_class, argv, runs):
+    results = dict()
+    
+    # first dispatch on a fresh app object: builds the tree for every level on the path (with phase timings)
+    with tempfile.NamedTemporaryFile('r', suffix=".jsonl") as timings_file:
+        os.environ[mlargparser.ENV_TIMINGS] = timings_file.name
+        
+        try:
+            tracemalloc.start()
+            started = time.perf_counter()
+            app = app_class(noparse=True)
+            app.run(argv, prog="bench")
+            results['first_dispatch_s'] = time.perf_counter() - started
+            results['first_dispatch_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            del os.environ[mlargparser.ENV_TIMINGS]
+        
+        results['first_dispatch_phases_s'] = json.loads(timings_file.readline())['phases']
+    
+    # warm dispatch latency: the tree is already built, so this is parsing, parser construction, and the call
+    samples = list()
+    
+    for _ in range(runs):
+        started = time.perf_counter()
+        app.run(argv, prog="bench")
+        samples.append(time.perf_counter() - started)
+    
+    results['dispatch_s'] = summarize(samples)
+    
+    # help rendering at the deepest command level, and for the leaf command itself
+    group_help = [measure_help(app_class(noparse=True), argv[:argv.index("--name") - 1] + ["-h"]) for _ in range(runs)]
+    leaf_help = [measure_help(app, argv[:argv.index("--name")] + ["-h"]) for _ in range(runs)]
+    results['help_s'] = summarize([elapsed for elapsed, _ in group_help])
+    results['help_chars'] = group_help[0][1]
+    results['leaf_help_s'] = summarize([elapsed for elapsed, _ in leaf_help])
+    
+    return results
+
+
+def run_scenario(scenario, directory, runs, cold_runs):
+    path, argv = generate_app(scenario, directory)
+    results = {'description': SCENARIOS[scenario], 'argv': argv}
+    
+    # cold starts, without and then with the on-disk schema cache (the first cached run populates the cache)
+    env = dict(os.environ)
+    env.pop(mlargparser.ENV_SCHEMA_CACHE, None)
+    results['cold_start_s'] = measure_cold_start(path, argv, cold_runs, env)
+    results['peak_rss_kib'] = measure_peak_rss(path, argv, env)
+    
+    env[mlargparser.ENV_SCHEMA_CACHE] = os.path.join(directory, "schema-cache")
+    measure_cold_start(path, argv, 1, env)
+    results['cold_start_cached_s'] = measure_cold_start(path, argv, cold_runs, env)
+    
+    results.update(measure_in_process(load_app(path), argv, runs))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MLArgParser dispatch overhead on synthetic command trees")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run (may be repeated; default: all)')
+    parser.add_argument('--runs', type=int, default=50, help='in-process repetitions per measurement')
+    parser.add_argument('--cold-runs', type=int, default=10, help='fresh interpreters per cold-start measurement')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+    
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mlargparser': mlargparser.__file__,
+        'scenarios': dict()
+    }
+    
+    with tempfile.TemporaryDirectory() as directory:
+        for scenario in args.scenario or sorted(SCENARIOS):
+            report['scenarios'][scenario] = run_scenario(scenario, directory, args.runs, args.cold_runs)
+    
+    output = json.dumps(report, indent=2)
+    
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
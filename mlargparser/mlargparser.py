@@ -5,13 +5,20 @@
 
 # Standard Library
 import argparse
+import contextlib
+import time
 import sys
-import shutil
 import os
+import shlex
 import ast
 import inspect
-
-from io import StringIO
+import re
+import json
+import mmap
+import stat
+import hashlib
+import importlib
+import tempfile
 
 # string to use for undocumented commands/arguments
 STR_UNDOCUMENTED = "FIXME: UNDOCUMENTED"
@@ -19,8 +26,30 @@ STR_UNDOCUMENTED = "FIXME: UNDOCUMENTED"
 # list of types that can be safely converted from string by the ast.literal_eval method
 AST_TYPES = [list, tuple, dict, set]
 
-# Set this environment variable to help the argparse formatter wrap the lines
-os.environ['COLUMNS'] = str(shutil.get_terminal_size().columns)
+# short options which are never generated for arguments (-h is argparse's --help)
+RESERVED_SHORT_OPTIONS = ("-h",)
+
+# default number of concurrent calls allowed by fan_out
+FAN_OUT_LIMIT = 32
+
+# version of the on-disk schema cache format (bump whenever the layout of the cached data changes)
+SCHEMA_VERSION = 2
+
+# environment variable naming a directory in which to cache command schemas for every app
+ENV_SCHEMA_CACHE = "MLARGPARSER_SCHEMA_CACHE"
+
+# environment variables which enable phase timings and profiling of the command body (see write_report for values)
+ENV_TIMINGS = "MLARGPARSER_TIMINGS"
+ENV_PROFILE = "MLARGPARSER_PROFILE"
+
+# number of functions (by cumulative time) to include in a profile report
+PROFILE_TOP_FUNCTIONS = 50
+
+# shells for which completion scripts can be generated
+COMPLETION_SHELLS = ("bash", "zsh")
+
+# header line of a generated completion script recording the schema it was generated from
+COMPLETION_SCHEMA_HEADER = "# mlargparser-completion-schema: "
 
 
 class CmdArg:
@@ -29,6 +58,7 @@ class CmdArg:
     type = None
     required = False
     action = ""
+    options = ()
     
     def __init__(self, signature, desc):
         self.name = signature.name
@@ -39,13 +69,562 @@ class CmdArg:
         self.action = "store_true" if self.type == bool else "store"
     
     def get_argparse_kwargs(self):
-        return {
+        kwargs = {
             'help': self.desc,
             'required': self.required,
             'dest': self.name,
             'type': self.parser,
             'action': self.action
         }
+        
+        # flag-style actions don't accept a type converter
+        if self.action == "store_true":
+            kwargs.pop('type')
+        
+        # file-backed arguments take a file name (or "-") rather than a literal value
+        if isinstance(self.type, type) and issubclass(self.type, FileArg):
+            kwargs['metavar'] = "@FILE"
+        
+        return kwargs
+
+
+class FileArg:
+    """ Base for argument types whose value is read from a file ("@path" or just "path") or from stdin ("-").
+    
+    Nothing is read while the command line is parsed (the file is only checked for existence), so the cost of parsing
+    doesn't depend on the size of the input.
+    """
+    
+    def __init__(self, value):
+        if value == "-":
+            self.path = None
+        else:
+            self.path = value[1:] if value.startswith("@") else value
+            
+            if not os.path.exists(self.path) or os.path.isdir(self.path):
+                raise argparse.ArgumentTypeError("can't read '%s': no such file" % self.path)
+    
+    @property
+    def name(self):
+        return "<stdin>" if self.path is None else self.path
+    
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.name)
+
+
+class LineStream(FileArg):
+    """ Lazily iterates over the lines of the input (without line endings), holding only one line in memory """
+    
+    def __iter__(self):
+        if self.path is None:
+            for line in sys.stdin:
+                yield line.rstrip("\r\n")
+        else:
+            with open(self.path, 'r') as input_file:
+                for line in input_file:
+                    yield line.rstrip("\r\n")
+
+
+class JSONLines(LineStream):
+    """ Lazily iterates over the records of JSON-lines input (blank lines are skipped) """
+    
+    def __iter__(self):
+        for line in super().__iter__():
+            if line.strip():
+                yield json.loads(line)
+
+
+class MappedFile(FileArg):
+    """ Read-only memory map of the input; use it as a context manager ("with arg as buffer:") to get the buffer.
+    
+    Stdin can only be mapped when it's redirected from a regular file.
+    """
+    
+    def __init__(self, value):
+        super().__init__(value)
+        
+        if self.path is None:
+            try:
+                redirected = stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode)
+            except (AttributeError, OSError, ValueError):
+                redirected = False
+            
+            if not redirected:
+                raise argparse.ArgumentTypeError("stdin can only be memory-mapped when redirected from a file")
+        
+        self.buffer = None
+    
+    def open(self):
+        # the mapping keeps its own reference to the file, so the file object can be closed straight away
+        if self.path is None:
+            return self.__map(sys.stdin.fileno())
+        
+        with open(self.path, 'rb') as input_file:
+            return self.__map(input_file.fileno())
+    
+    @staticmethod
+    def __map(fileno):
+        # empty files can't be mapped
+        if os.fstat(fileno).st_size == 0:
+            return b""
+        
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    
+    def __enter__(self):
+        self.buffer = self.open()
+        return self.buffer
+    
+    def __exit__(self, *exc_info):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        
+        self.buffer = None
+
+
+def type_to_ref(obj):
+    # build an importable "module:qualname" reference to a type, or None if it can't be reliably re-imported
+    module = getattr(obj, '__module__', None)
+    qualname = getattr(obj, '__qualname__', None)
+    
+    if not module or not qualname or '<locals>' in qualname:
+        return None
+    
+    ref = "%s:%s" % (module, qualname)
+    
+    try:
+        return ref if ref_to_type(ref) is obj else None
+    except (ImportError, AttributeError):
+        return None
+
+
+def ref_to_type(ref):
+    # resolve a reference created by type_to_ref back into the object it names
+    module, qualname = ref.split(":", 1)
+    obj = importlib.import_module(module)
+    
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    
+    return obj
+
+
+def run_async(awaitable):
+    """ Run an awaitable to completion on a private event loop and return its result.
+    
+    On Ctrl-C (or any other error) every task still running on the loop is cancelled and allowed to clean up before
+    the exception propagates.
+    """
+    # asyncio takes several times longer to import than the rest of the library, so only async commands pay for it
+    import asyncio
+    
+    loop = asyncio.new_event_loop()
+    
+    try:
+        return loop.run_until_complete(asyncio.ensure_future(awaitable, loop=loop))
+    finally:
+        try:
+            pending = asyncio.all_tasks(loop)
+            
+            for task in pending:
+                task.cancel()
+            
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+
+async def fan_out(func, items, limit=FAN_OUT_LIMIT):
+    """ Await func(item) for every item (e.g. a list or set argument) with at most limit calls in flight.
+    
+    Results are returned in the same order as items.  If any call fails, the calls still in flight are cancelled and
+    the exception is raised.
+    """
+    import asyncio
+    
+    # (with no calls allowed in flight nothing would ever run)
+    if limit < 1:
+        raise ValueError("fan_out limit must be at least 1, not %r" % (limit,))
+    
+    items = list(items)
+    results = [None] * len(items)
+    queue = iter(enumerate(items))
+    
+    # a fixed set of workers pulling from a shared iterator keeps memory flat no matter how many items there are
+    async def worker():
+        for index, item in queue:
+            results[index] = await func(item)
+    
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(limit, len(items)))]
+    
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+    
+    return results
+
+
+def get_report_destination(variable):
+    # where a report switched on by an environment variable goes; None when it's unset, empty or "0"/"false"/"no"
+    destination = os.environ.get(variable, "")
+    
+    if destination.lower() in ("", "0", "false", "no", "off"):
+        return None
+    
+    return destination
+
+
+def write_report(report, destination):
+    # "1"/"stderr"/"-" prints the report as one line of JSON on stderr; anything else is a file to append it to
+    line = json.dumps(report) + "\n"
+    
+    if destination.lower() in ("1", "true", "stderr", "-"):
+        sys.stderr.write(line)
+    else:
+        with open(destination, 'a') as report_file:
+            report_file.write(line)
+
+
+class PhaseTimer:
+    """ Accumulates the wall-clock time spent in each phase of dispatching a command line """
+    
+    PHASES = ("discovery", "parser_build", "parse", "execute")
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(self.PHASES, 0.0)
+        self.__stack = list()
+        self.__mark = self.started
+    
+    @contextlib.contextmanager
+    def phase(self, name):
+        # a nested phase pauses the enclosing one, so every moment is attributed to exactly one phase
+        now = time.perf_counter()
+        
+        if self.__stack:
+            self.phases[self.__stack[-1]] += now - self.__mark
+        
+        self.__stack.append(name)
+        self.__mark = now
+        
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.phases[self.__stack.pop()] += now - self.__mark
+            self.__mark = now
+    
+    def get_report(self, argv):
+        total = time.perf_counter() - self.started
+        
+        return {
+            'argv': argv,
+            'phases': self.phases,
+            'overhead': total - self.phases['execute'],
+            'total': total
+        }
+
+
+def get_profile_report(profiler, argv):
+    # flatten cProfile's statistics into plain data, most expensive functions (by cumulative time) first
+    import pstats
+    
+    stats = pstats.Stats(profiler).stats
+    functions = list()
+    
+    for (filename, line, function), (primitive_calls, calls, tottime, cumtime, callers) in stats.items():
+        functions.append({
+            'function': function,
+            'file': filename,
+            'line': line,
+            'calls': calls,
+            'primitive_calls': primitive_calls,
+            'tottime': tottime,
+            'cumtime': cumtime
+        })
+    
+    functions.sort(key=lambda function: function['cumtime'], reverse=True)
+    
+    return {
+        'argv': argv,
+        'total_calls': sum(function['calls'] for function in functions),
+        'functions': functions[:PROFILE_TOP_FUNCTIONS]
+    }
+
+
+def get_bash_completion(prog, paths, fingerprint):
+    func = "_mlargparser_%s" % re.sub(r'\W', "_", prog)
+    lines = [
+        "# bash completion for %s (generated by mlargparser; regenerate with: %s --completion bash)" % (prog, prog),
+        COMPLETION_SCHEMA_HEADER + fingerprint,
+        "%s() {" % func,
+        '    local cur="${COMP_WORDS[COMP_CWORD]}" prev="${COMP_WORDS[COMP_CWORD-1]}" cmdpath="" i',
+        '    for ((i = 1; i < COMP_CWORD; i++)); do',
+        '        case "${COMP_WORDS[i]}" in -*) break ;; esac',
+        '        cmdpath="$cmdpath ${COMP_WORDS[i]}"',
+        '    done',
+        '    case "$cmdpath" in'
+    ]
+    
+    for path in paths:
+        lines.append('        %s)' % "|".join('"%s"' % pattern for pattern in get_completion_patterns(path['path'])))
+        
+        if path['value_options'] or path['file_options']:
+            lines.append('            case "$prev" in')
+            
+            if path['file_options']:
+                lines.append('                %s) compopt -o filenames 2>/dev/null; COMPREPLY=($(compgen -f -- "$cur")); return ;;' % "|".join(path['file_options']))
+            
+            if path['value_options']:
+                lines.append('                %s) return ;;' % "|".join(path['value_options']))
+            
+            lines.append('            esac')
+        
+        lines.append('            COMPREPLY=($(compgen -W "%s" -- "$cur")) ;;' % " ".join(path['words']))
+    
+    lines += [
+        '    esac',
+        '}',
+        'complete -F %s %s' % (func, prog),
+        ''
+    ]
+    
+    return "\n".join(lines)
+
+
+def get_zsh_completion(prog, paths, fingerprint):
+    func = "_mlargparser_%s" % re.sub(r'\W', "_", prog)
+    lines = [
+        "#compdef %s" % prog,
+        "# zsh completion for %s (generated by mlargparser; regenerate with: %s --completion zsh)" % (prog, prog),
+        COMPLETION_SCHEMA_HEADER + fingerprint,
+        "%s() {" % func,
+        '    local prev="${words[CURRENT-1]}" cmdpath="" i',
+        '    for ((i = 2; i < CURRENT; i++)); do',
+        '        [[ "${words[i]}" == -* ]] && break',
+        '        cmdpath="$cmdpath ${words[i]}"',
+        '    done',
+        '    case "$cmdpath" in'
+    ]
+    
+    for path in paths:
+        lines.append('        (%s)' % "|".join('"%s"' % pattern for pattern in get_completion_patterns(path['path'])))
+        
+        if path['value_options'] or path['file_options']:
+            lines.append('            case "$prev" in')
+            
+            if path['file_options']:
+                lines.append('                (%s) _files; return ;;' % "|".join(path['file_options']))
+            
+            if path['value_options']:
+                lines.append('                (%s) return ;;' % "|".join(path['value_options']))
+            
+            lines.append('            esac')
+        
+        lines.append('            compadd -- %s ;;' % " ".join(path['words']))
+    
+    lines += [
+        '    esac',
+        '}',
+        '',
+        '# works both when sourced and when autoloaded from $fpath',
+        'if [[ "${zsh_eval_context[-1]}" == loadautofunc ]]; then',
+        '    %s "$@"' % func,
+        'else',
+        '    compdef %s %s' % (func, prog),
+        'fi',
+        ''
+    ]
+    
+    return "\n".join(lines)
+
+
+def get_completion_patterns(path):
+    # commands are matched case-insensitively, so accept the path as declared and in lower-case
+    patterns = ["".join(" %s" % word for word in path)]
+    
+    if patterns[0].lower() != patterns[0]:
+        patterns.append(patterns[0].lower())
+    
+    return patterns
+
+
+class LazyCommand:
+    """ Sub-command class referenced by an import path ("package.module:ClassName") and only imported when dispatched.
+    
+    Assign one to an attribute of an app class in place of a nested class; doc is shown in the list of available
+    commands without having to import the module.
+    """
+    
+    def __init__(self, path, doc=None):
+        self.path = path
+        self.__doc__ = doc
+    
+    def load(self):
+        return ref_to_type(self.path)
+    
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+class SchemaCache:
+    """ On-disk cache of an app's command tree, validated against the source files it was built from """
+    
+    def __init__(self, path):
+        self.path = path
+        self.sources = dict()
+        self.dirty = False
+    
+    @staticmethod
+    def get_default_path(app_class, directory=None):
+        # pick a per-app file name that can't collide between scripts which share a module name (e.g. __main__)
+        if directory is None:
+            directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser("~/.cache"), "mlargparser")
+        
+        source = os.path.abspath(inspect.getsourcefile(app_class) or app_class.__module__)
+        digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+        name = "%s.%s-%s.json" % (os.path.splitext(os.path.basename(source))[0], app_class.__qualname__, digest)
+        
+        return os.path.join(directory, name)
+    
+    @staticmethod
+    def __fingerprint(path, with_hash=True):
+        stat = os.stat(path)
+        fingerprint = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        
+        if with_hash:
+            with open(path, 'rb') as source_file:
+                fingerprint['sha256'] = hashlib.sha256(source_file.read()).hexdigest()
+        
+        return fingerprint
+    
+    def add_sources(self, classes):
+        # track the source files of the given classes so edits to them invalidate the cache
+        for cls in classes:
+            try:
+                path = inspect.getsourcefile(cls)
+            except TypeError:
+                path = None
+            
+            if path and path not in self.sources:
+                self.sources[path] = self.__fingerprint(path)
+                self.dirty = True
+    
+    def load(self, app_key):
+        # return the cached command tree, or None if there is no cache or any of its sources changed
+        try:
+            with open(self.path, 'r') as cache_file:
+                data = json.load(cache_file)
+            
+            if data.get('version') != SCHEMA_VERSION or data.get('app') != app_key:
+                return None
+            
+            for path, cached in data['sources'].items():
+                current = self.__fingerprint(path, with_hash=False)
+                
+                # cheap check first; only hash the file when its mtime/size moved
+                if current['mtime_ns'] != cached['mtime_ns'] or current['size'] != cached['size']:
+                    current = self.__fingerprint(path)
+                    
+                    if current['sha256'] != cached['sha256']:
+                        return None
+                    
+                    data['sources'][path] = current
+                    self.dirty = True
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+        
+        self.sources = data['sources']
+        return data['schema']
+    
+    def save(self, app_key, schema):
+        if not self.dirty:
+            return
+        
+        data = {'version': SCHEMA_VERSION, 'app': app_key, 'sources': self.sources, 'schema': schema}
+        
+        # write atomically so a concurrent invocation never reads a partial cache; failures just mean no cache
+        try:
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix=".tmp") as cache_file:
+                json.dump(data, cache_file)
+            
+            os.replace(cache_file.name, self.path)
+            self.dirty = False
+        except OSError:
+            pass
+
+
+class MLArgParserError(Exception):
+    """ Raised instead of printing an error and exiting when a command line can't be dispatched """
+    
+    def __init__(self, message, parser=None, status=2):
+        super().__init__(message)
+        self.message = message
+        self.parser = parser
+        self.status = status
+        
+        # whether the full help should accompany the error (e.g. when required arguments are missing)
+        self.show_help = False
+    
+    @property
+    def prog(self):
+        return self.parser.prog if self.parser else None
+    
+    @property
+    def usage(self):
+        return self.parser.format_usage() if self.parser else ""
+    
+    @property
+    def help(self):
+        return self.parser.format_help() if self.parser else ""
+
+
+class UnknownCommandError(MLArgParserError):
+    """ Raised when a command line names a command which doesn't exist """
+    
+    def __init__(self, command, parser):
+        super().__init__("Unrecognized command: %s" % command, parser, status=1)
+        self.command = command
+        self.show_help = True
+
+
+class HelpRequested(MLArgParserError):
+    """ Raised when -h/--help is given; the help text is available from the help attribute """
+    
+    def __init__(self, parser):
+        super().__init__("help requested", parser, status=0)
+
+
+class CmdHelpAction(argparse.Action):
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
+    
+    def __call__(self, parser, namespace, values, option_string=None):
+        raise HelpRequested(parser)
+
+
+class CmdParser(argparse.ArgumentParser):
+    """ ArgumentParser which raises MLArgParserError instead of writing to stdout/stderr and exiting """
+    
+    def register(self, registry_name, value, object):
+        # swap in a help action which raises instead of printing the help and exiting
+        if registry_name == 'action' and value == 'help':
+            object = CmdHelpAction
+        
+        return super().register(registry_name, value, object)
+    
+    def error(self, message):
+        raise MLArgParserError(message, self)
+    
+    def exit(self, status=0, message=None):
+        raise MLArgParserError((message or "").strip(), self, status)
 
 
 class MLArgParser:
@@ -54,12 +633,16 @@ class MLArgParser:
     # mapping of command arguments to descriptions (initialized in constructor)
     argDesc = None
     
-    # mapping of lower-case commands to method names and attributes (initialized in __init_commands)
+    # mapping of lower-case commands to schema entries (name, group flag, sub-commands) (initialized in __init_schema)
     commands = None
     
-    # list for tracking auto-generated short options (initialized in __get_cmd_parser)
+    # list for tracking auto-generated short options (initialized in __get_arg_properties)
     short_options = None
     
+    # on-disk command schema cache: a file path, True for the default location, or None to disable
+    # (the MLARGPARSER_SCHEMA_CACHE environment variable can name a cache directory for all apps instead)
+    schemaCache = None
+    
     def __init__(self, level=1, parent=None, top=None, noparse=False):
         # indicate how many command-levels deep we are
         self.level = level
@@ -70,12 +653,316 @@ class MLArgParser:
         # keep track of our top-level command
         self.top = top if level > 1 else self
         
+        # parser for this command level (initialized in __get_parser)
+        self.parser = None
+        
+        # argument objects and docstrings for each command, keyed by method name (initialized in __get_cmd_args and
+        # __get_cmd_doc, only for the commands which need them)
+        self.__cmd_args = dict()
+        self.__cmd_docs = dict()
+        
+        # sub-command objects, keyed by class name (initialized in __get_child)
+        self.__children = dict()
+        
+        # command line currently being dispatched, including the program name (initialized in __dispatch)
+        self.__argv = None
+        
+        # on-disk schema cache, if enabled (initialized in __init_schema)
+        self.__schema_cache = None
+        
+        # phase timings for the command line being dispatched, if enabled (initialized in __dispatch_top)
+        self.__timer = None
+        
         if noparse:
             return
         
-        # build a dictionary of all commands
-        self.__init_commands()
+        # dispatch the process's own command line, printing help/errors and exiting the way argparse does
+        self.__main(sys.argv)
+    
+    def run(self, args, prog=None):
+        """ Dispatch a single command line (not including the program name) and return the command's result.
+        
+        Unlike constructing the app normally, this never prints, exits, or modifies global state; bad command lines
+        and help requests raise MLArgParserError (or a subclass) instead.  The command tree is only built on
+        the first call, so an app object created with noparse=True can dispatch any number of command lines.
+        """
+        if prog is None:
+            prog = os.path.basename(sys.argv[0])
+        
+        return self.__dispatch_top([prog] + list(args))
+    
+    def run_batch(self, lines, prog=None):
+        """ Run each line of an iterable (e.g. an open file) as a separate command line; returns the number of failures.
+        
+        Blank lines and lines starting with "#" are skipped.  Errors are reported on stderr (prefixed with the line
+        number) and the remaining lines still run.
+        """
+        failures = 0
+        
+        for line_number, line in enumerate(lines, 1):
+            line = line.strip()
+            
+            if not line or line.startswith("#"):
+                continue
+            
+            try:
+                args = shlex.split(line)
+            except ValueError as parse_error:
+                sys.stderr.write("line %d: %s\n" % (line_number, parse_error))
+                failures += 1
+                continue
+            
+            try:
+                # (called through the class in case the app has a command which shadows run)
+                MLArgParser.run(self, args, prog)
+            except HelpRequested as help_request:
+                sys.stdout.write(help_request.help)
+            except MLArgParserError as err:
+                sys.stderr.write("line %d: %s: error: %s\n" % (line_number, err.prog, err.message))
+                failures += 1
+            except SystemExit as exit_signal:
+                # commands written for one-shot use may call exit(); that shouldn't end the whole batch
+                if exit_signal.code:
+                    failures += 1
+            except Exception as error:
+                # a command which fails is that line's failure, not the batch's
+                sys.stderr.write("line %d: %s: %s\n" % (line_number, type(error).__name__, error))
+                failures += 1
+        
+        return failures
+    
+    def generate_completion(self, shell, prog=None):
+        """ Return a self-contained bash or zsh completion script covering every command, sub-command and option """
+        if shell not in COMPLETION_SHELLS:
+            raise ValueError("unsupported shell for completion: %s" % shell)
+        
+        if prog is None:
+            prog = os.path.basename(sys.argv[0])
+        
+        paths = list(self.__get_completion_paths())
+        fingerprint = hashlib.sha256(json.dumps([shell, prog, paths]).encode()).hexdigest()
+        
+        if shell == "zsh":
+            return get_zsh_completion(prog, paths, fingerprint)
         
+        return get_bash_completion(prog, paths, fingerprint)
+    
+    def write_completion(self, shell, path, prog=None):
+        """ Write a completion script to path unless the one already there was generated from the same schema.
+        
+        Returns True if the file was (re)written.
+        """
+        script = self.generate_completion(shell, prog)
+        header = [line for line in script.splitlines() if line.startswith(COMPLETION_SCHEMA_HEADER)]
+        
+        try:
+            with open(path, 'r') as script_file:
+                if header[0] in script_file.read().splitlines():
+                    return False
+        except OSError:
+            pass
+        
+        with open(path, 'w') as script_file:
+            script_file.write(script)
+        
+        return True
+    
+    def __get_completion_paths(self, path=()):
+        # walk the whole command tree, describing what can be completed after each command path
+        if self.commands is None:
+            self.__init_schema()
+        
+        entries = sorted(self.commands.values(), key=lambda entry: entry['name'])
+        words = [entry['name'] for entry in entries] + ["-h", "--help"]
+        
+        if self.level == 1:
+            words += ["--batch", "--completion"]
+        
+        yield {'path': list(path), 'words': words, 'value_options': [], 'file_options': []}
+        
+        for entry in entries:
+            if entry['group']:
+                yield from self.__get_child(entry).__get_completion_paths(path + (entry['name'],))
+                continue
+            
+            completion = {'path': list(path + (entry['name'],)), 'words': [], 'value_options': [], 'file_options': []}
+            
+            for arg in self.__get_cmd_args(entry):
+                completion['words'] += arg.options
+                
+                # options which take a value complete that value (file names, or nothing) instead of another option
+                if arg.action != "store_true":
+                    is_file = isinstance(arg.type, type) and issubclass(arg.type, FileArg)
+                    completion['file_options' if is_file else 'value_options'] += arg.options
+            
+            completion['words'] += ["-h", "--help"]
+            yield completion
+    
+    def __main(self, argv):
+        try:
+            # batch mode: run command lines from a file (or stdin) with the command tree built only once
+            if self.level == 1 and argv[1:2] == ["--batch"]:
+                source = argv[2] if len(argv) > 2 else "-"
+                
+                if source == "-":
+                    failures = self.run_batch(sys.stdin, argv[0])
+                else:
+                    with open(source, 'r') as batch_file:
+                        failures = self.run_batch(batch_file, argv[0])
+                
+                sys.exit(1 if failures else 0)
+            
+            # completion mode: print a shell completion script, or write it to a file if the schema has changed
+            if self.level == 1 and argv[1:2] == ["--completion"]:
+                if len(argv) not in (3, 4) or argv[2] not in COMPLETION_SHELLS:
+                    sys.stderr.write("usage: %s --completion {%s} [FILE]\n" % (argv[0], ",".join(COMPLETION_SHELLS)))
+                    sys.exit(2)
+                
+                prog = os.path.basename(argv[0])
+                
+                if len(argv) == 3:
+                    sys.stdout.write(self.generate_completion(argv[2], prog))
+                elif not self.write_completion(argv[2], argv[3], prog):
+                    sys.stderr.write("%s is already up to date\n" % argv[3])
+                
+                sys.exit(0)
+            
+            self.__dispatch_top(argv)
+        except MLArgParserError as err:
+            self.__report_error(err)
+            sys.exit(err.status)
+    
+    @staticmethod
+    def __report_error(err):
+        # reproduce argparse's own output for help and errors
+        if isinstance(err, HelpRequested):
+            sys.stdout.write(err.help)
+        elif isinstance(err, UnknownCommandError):
+            print(err.message)
+            sys.stdout.write(err.help)
+        elif err.show_help:
+            sys.stdout.write(err.help)
+            sys.stderr.write("\n%s: error: %s\n\n" % (err.prog, err.message))
+        else:
+            sys.stderr.write(err.usage)
+            sys.stderr.write("%s: error: %s\n" % (err.prog, err.message))
+    
+    def __dispatch_top(self, argv):
+        # phase timings are switched on per command line through the environment
+        timings = get_report_destination(ENV_TIMINGS)
+        self.__timer = PhaseTimer() if timings else None
+        
+        try:
+            # build a dictionary of all commands (from the schema cache if possible)
+            with self.__phase("discovery"):
+                if self.commands is None:
+                    self.__init_schema()
+            
+            return self.__dispatch(argv)
+        finally:
+            if self.__timer is not None:
+                write_report(self.__timer.get_report(argv), timings)
+                self.__timer = None
+    
+    def __phase(self, name):
+        # time a phase of the dispatch (a no-op unless timings are enabled)
+        timer = self.top.__timer
+        return timer.phase(name) if timer is not None else contextlib.nullcontext()
+    
+    def __dispatch(self, argv):
+        self.__argv = argv
+        
+        # the usage line of the parser depends on the command line, so never reuse one from a previous dispatch
+        self.parser = None
+        
+        # parse only the first argument after the current command
+        with self.__phase("parse"):
+            parsed_command = self.__parse_command(argv[self.level:self.level + 1])
+        
+        # make sure it's a valid command and find the corresponding schema entry
+        entry = self.__get_cmd_entry(parsed_command)
+        
+        # sub-commands continue dispatching from the next level down
+        if entry['group']:
+            with self.__phase("discovery"):
+                child = self.__get_child(entry)
+            
+            return child.__dispatch(argv)
+        
+        # get a dictionary representing the arguments for the command
+        with self.__phase("parse"):
+            callable_args = self.__parse_cmd_args(entry)
+        
+        # invoke the callable for the command with all provided arguments
+        with self.__phase("execute"):
+            return self.__execute(getattr(self, entry['name']), callable_args)
+    
+    def __execute(self, command_callable, callable_args):
+        # optionally profile the command body
+        profile = get_report_destination(ENV_PROFILE)
+        profiler = None
+        
+        # (the profiler's modules are only imported when it's asked for)
+        if profile:
+            import cProfile
+            
+            profiler = cProfile.Profile()
+            profiler.enable()
+        
+        try:
+            result = command_callable(**callable_args)
+            
+            # async commands are run to completion on an event loop managed by the parser
+            if inspect.isawaitable(result):
+                result = run_async(result)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                write_report(get_profile_report(profiler, self.__argv), profile)
+        
+        return result
+    
+    def __get_parser(self):
+        # create our top-level parser on first use (it's only needed for help output and errors)
+        if self.parser is not None:
+            return self.parser
+        
+        with self.__phase("parser_build"):
+            self.parser = CmdParser(
+                prog=os.path.basename(self.__argv[0]),
+                description=inspect.getdoc(self),
+                usage=(("%s " * self.level) + "<command> [<args>]") % tuple(self.__argv[0:self.level]),
+                epilog=self.__get_epilog_str(),
+                formatter_class=argparse.RawDescriptionHelpFormatter
+            )
+            
+            self.parser.add_argument('command', help='Sub-command to run')
+            
+            if self.level == 1:
+                self.parser.add_argument(
+                    '--batch', metavar='FILE', nargs='?',
+                    help='run newline-delimited command lines from FILE (or stdin) in a single process'
+                )
+                self.parser.add_argument(
+                    '--completion', metavar='SHELL',
+                    help='print a %s completion script (--completion SHELL FILE only rewrites FILE if the commands '
+                         'changed)' % "/".join(COMPLETION_SHELLS)
+                )
+        
+        return self.parser
+    
+    def __parse_command(self, args):
+        # fast path: a plain, known command name needs neither the parser nor the "available commands" epilog
+        if len(args) == 1 and not args[0].startswith("-"):
+            parsed_command = args[0].lower()
+            
+            if not parsed_command.startswith("_") and parsed_command in self.commands:
+                return parsed_command
+        
+        # anything else (help, options, missing or unknown commands) goes through argparse for the usual output
+        return self.__get_parser().parse_args(args).command.lower()
+    
+    def __init_arg_desc(self):
         # try to inherit the argDesc dictionary from the parent
         if self.parent and self.parent.argDesc:
             combinedArgDesc = dict(self.parent.argDesc)
@@ -88,59 +975,91 @@ class MLArgParser:
                 combinedArgDesc[key] = value
         
         self.argDesc = combinedArgDesc
+    
+    def __init_schema(self, schema=None):
+        # sub-commands receive their part of the schema (if any) from the parent
+        self.__init_arg_desc()
         
-        # create our top-level parser
-        self.parser = argparse.ArgumentParser(
-            description=inspect.getdoc(self),
-            usage=(("%s " * level) + "<command> [<args>]") % tuple(sys.argv[0:level]),
-            epilog=self.__get_epilog_str(),
-            formatter_class=argparse.RawDescriptionHelpFormatter
-        )
+        if schema is None and self.__get_schema_cache_path():
+            self.__schema_cache = SchemaCache(self.__get_schema_cache_path())
+            schema = self.__schema_cache.load(type_to_ref(type(self)))
+            
+            if schema is None:
+                # cache miss: walk the whole command tree once and store it for the next run
+                self.__init_commands()
+                schema = self.__build_schema()
+            
+            # (re)write the cache if it was rebuilt or any source only had its mtime touched
+            self.__schema_cache.save(type_to_ref(type(self)), schema)
         
-        self.parser.add_argument('command', help='Sub-command to run')
+        if schema is None:
+            self.__init_commands()
+        else:
+            self.commands = schema
+    
+    def __get_schema_cache_path(self):
+        # only the top-level app owns a cache, and only classes that can be re-imported by reference can use one
+        if self.level > 1 or type_to_ref(type(self)) is None:
+            return None
         
-        # parse only the first argument after the current command
-        parsed_command = self.parser.parse_args(sys.argv[level:level + 1]).command.lower()
+        if isinstance(self.schemaCache, str):
+            return self.schemaCache
         
-        # make sure it's a valid command and find the corresponding callable
-        command_callable = self.__get_cmd_callable(parsed_command)
+        if self.schemaCache:
+            return SchemaCache.get_default_path(type(self))
         
-        # get a dictionary representing the arguments for the command
-        callable_args = self.__parse_cmd_args(command_callable)
+        if os.environ.get(ENV_SCHEMA_CACHE):
+            return SchemaCache.get_default_path(type(self), os.environ[ENV_SCHEMA_CACHE])
         
-        # invoke the callable for the command with all provided arguments
-        command_callable(**callable_args)
+        return None
+    
+    def __build_schema(self):
+        # the whole command tree below this level, so it can be serialized: only what dispatch needs to find a command
+        # (names and which are groups); a command's docstring and arguments are looked up once it's dispatched, so
+        # loading the cache costs no more than finding one command the slow way
+        self.top.__schema_cache.add_sources([cls for cls in type(self).__mro__ if cls not in (MLArgParser, object)])
+        self.top.__schema_cache.add_sources([MLArgParser])
+        
+        for entry in self.commands.values():
+            # lazily-loaded sub-commands are added to the schema the first time they're dispatched
+            if entry['group'] and not entry.get('lazy'):
+                entry['commands'] = self.__get_child(entry).__build_schema()
+        
+        return self.commands
+    
+    def __get_child(self, entry):
+        # sub-command objects are created once and reused for every dispatch through this level
+        child = self.__children.get(entry['name'])
+        
+        if child is None:
+            child = getattr(self, entry['name'])(level=self.level + 1, parent=self, top=self.top, noparse=True)
+            child.__init_schema(entry.get('commands'))
+            self.__children[entry['name']] = child
+            
+            # a lazily-loaded branch which has just been imported for the first time gets added to the schema cache
+            if entry.get('lazy') and 'commands' not in entry and self.top.__schema_cache is not None:
+                entry['commands'] = child.__build_schema()
+                self.top.__schema_cache.save(type_to_ref(type(self.top)), self.top.commands)
+        
+        return child
     
-    def __parse_cmd_args(self, command_callable):
-        # intercept sub-commands
-        if isinstance(command_callable, type):
-            return {'level': self.level + 1, 'parent': self, 'top': self.top}
+    def __parse_cmd_args(self, entry):
+        # introspect (or load from the schema) the command's arguments
+        with self.__phase("discovery"):
+            self.__get_cmd_args(entry)
         
         # get a parser object for the command function
-        cmd_parser = self.__get_cmd_parser(command_callable)
+        with self.__phase("parser_build"):
+            cmd_parser = self.__get_cmd_parser(entry)
         
         # try to extract a list of args for the command
         try:
-            # Redirect stderr so we can catch and process output from argparse
-            stderr = sys.stderr
-            sys.stderr = StringIO()
-            
-            # Parse the arguments
-            parsed = cmd_parser.parse_args(sys.argv[self.level + 1:])
+            parsed = cmd_parser.parse_args(self.__argv[self.level + 1:])
             func_args = vars(parsed)
-        except SystemExit as exit_signal:
-            parser_output = sys.stderr.getvalue()
-            
-            # Nastiness ahead...
-            if parser_output.find("error: the following arguments are required:") != -1:
-                cmd_parser.print_help()
-                stderr.write('\n%s\n' % '\n'.join(parser_output.split('\n')[1:]))
-            else:
-                stderr.write(parser_output)
-            
-            raise exit_signal
-        finally:
-            sys.stderr = stderr
+        except MLArgParserError as err:
+            # missing required arguments are easier to fix with the full help in view
+            err.show_help = err.message.startswith("the following arguments are required:")
+            raise
         
         # iterate through the args and remove any that weren't specified
         for key in list(func_args.keys()):
@@ -148,14 +1067,11 @@ class MLArgParser:
         
         return func_args
     
-    def __get_cmd_callable(self, parsed_command):
-        if parsed_command.startswith("_") or parsed_command not in list(self.commands.keys()):
-            print(('Unrecognized command: %s' % parsed_command))
-            self.parser.print_help()
-            exit(1)
+    def __get_cmd_entry(self, parsed_command):
+        if parsed_command.startswith("_") or parsed_command not in self.commands:
+            raise UnknownCommandError(parsed_command, self.__get_parser())
         
-        # create a parser for the command
-        return self.commands[parsed_command][1]
+        return self.commands[parsed_command]
     
     def __init_commands(self):
         if self.commands:
@@ -166,8 +1082,32 @@ class MLArgParser:
         for attr_name in dir(self):
             attr = getattr(self, attr_name)
             
-            if callable(attr) and not attr_name.startswith("_"):
-                self.commands[attr_name.lower()] = (attr_name, attr)
+            if callable(attr) and not attr_name.startswith("_") and not self.__is_builtin_method(attr_name):
+                self.commands[attr_name.lower()] = {'name': attr_name, 'group': isinstance(attr, (type, LazyCommand))}
+                
+                if isinstance(attr, LazyCommand):
+                    self.commands[attr_name.lower()]['lazy'] = True
+    
+    def __is_builtin_method(self, attr_name):
+        # MLArgParser's own API methods (run, run_batch, ...) aren't commands unless the app overrides them
+        return attr_name in vars(MLArgParser) and getattr(MLArgParser, attr_name) is getattr(type(self), attr_name)
+    
+    def __get_cmd_doc(self, entry):
+        # look up (and remember) the docstring for a command
+        if entry['name'] not in self.__cmd_docs:
+            self.__cmd_docs[entry['name']] = inspect.getdoc(getattr(self, entry['name']))
+        
+        return self.__cmd_docs[entry['name']]
+    
+    def __get_cmd_args(self, entry):
+        args = self.__cmd_args.get(entry['name'])
+        
+        if args is not None:
+            return args
+        
+        args = list(self.__get_arg_properties(getattr(self, entry['name'])))
+        self.__cmd_args[entry['name']] = args
+        return args
     
     def __get_epilog_str(self):
         # start with a header
@@ -177,13 +1117,13 @@ class MLArgParser:
         cmd_list = list()
         
         # build a list of all commands with descriptions
-        for (cmd_name, attr) in self.commands.values():
-            desc = inspect.getdoc(attr)
+        for entry in self.commands.values():
+            desc = self.__get_cmd_doc(entry)
             
             if not desc:
                 desc = STR_UNDOCUMENTED
             
-            cmd_list.append([cmd_name, desc])
+            cmd_list.append([entry['name'], desc])
         
         # determine the max width for the commands column
         if len(cmd_list):
@@ -196,9 +1136,9 @@ class MLArgParser:
         return epilog + " "
     
     def __get_options_for_arg(self, arg):
-        # initialize short options tracker
+        # initialize short options tracker (-h always belongs to --help)
         if not self.short_options:
-            self.short_options = list()
+            self.short_options = list(RESERVED_SHORT_OPTIONS)
         
         # underscores in argument names are uncool, so replace them with dashes
         long_option = "--%s" % arg.replace("_", "-")
@@ -213,6 +1153,9 @@ class MLArgParser:
             return long_option,
     
     def __get_arg_properties(self, command_callable):
+        # short options are allocated per command
+        self.short_options = list(RESERVED_SHORT_OPTIONS)
+        
         # Iterate through each parameter in the callable's signature
         for arg in inspect.signature(command_callable).parameters.values():
             # Determine if we have a description for the parameter, if not use the default text
@@ -221,25 +1164,27 @@ class MLArgParser:
             else:
                 desc = self.argDesc[arg.name]
             
+            # determine the long and/or short option names for the argument
+            cmd_arg = CmdArg(arg, desc)
+            cmd_arg.options = self.__get_options_for_arg(arg.name)
+            
             # Yield an argument object back to the caller
-            yield CmdArg(arg, desc)
+            yield cmd_arg
     
-    def __get_cmd_parser(self, command_callable):
+    def __get_cmd_parser(self, entry):
         # Offset the level from the one passed to the constructor (to skip parsing the previous command)
         level = self.level + 1
         
         # create a parser for the command and a group to track required args
-        parser = argparse.ArgumentParser(
-            description=inspect.getdoc(command_callable),
-            usage=(("%s " * level) + "[<args>]") % tuple(sys.argv[0:level])
+        parser = CmdParser(
+            prog=os.path.basename(self.__argv[0]),
+            description=self.__get_cmd_doc(entry),
+            usage=(("%s " * level) + "[<args>]") % tuple(self.__argv[0:level])
         )
         req_args_grp = parser.add_argument_group("required arguments")
         
         # populate the parser with the arg and type information from the function
-        for arg in self.__get_arg_properties(command_callable):
-            # determine the long and/or short option names for the argument
-            options = self.__get_options_for_arg(arg.name)
-            
+        for arg in self.__get_cmd_args(entry):
             # get the argparse-compatible keyword list for the argument
             kwargs = arg.get_argparse_kwargs()
             
@@ -247,7 +1192,7 @@ class MLArgParser:
             grp = req_args_grp if arg.required else parser
             
             # add the argument to the appropriate group
-            grp.add_argument(*options, **kwargs)
+            grp.add_argument(*arg.options, **kwargs)
         
         return parser
 
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# Benchmark suite for pystreamcatcher, run against the local stand-in stream server (streamserver.py).
+#
+# Each scenario runs the catcher in a fresh interpreter which reports its own CPU time and peak RSS, with a stats
+# file for the per-stream numbers, and measures sustained throughput, CPU%, memory, and how close each capture
+# stopped to its deadline.  Scenarios cover single streams (unpaced, chunked, and at a typical audio bitrate), many
+# concurrent streams, and a stream which stalls and drops its connection.  Results are emitted as JSON so they can
+# be compared across changes.  The server is Python too: unpaced throughput is partly bounded by it, so compare
+# unpaced numbers only between runs on the same host.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CATCHER = os.path.join(HERE, "pystreamcatcher.py")
+SERVER = os.path.join(HERE, "streamserver.py")
+
+sys.path.insert(0, HERE)
+
+from streamserver import checkPattern  # noqa: E402
+
+# the shapes of capture to benchmark: a description, and the query strings of the streams to capture (a function of
+# the number of concurrent streams asked for)
+SCENARIOS = {
+  'single': ("one unpaced stream", lambda streams: [""]),
+  'single-chunked': ("one unpaced stream, chunked", lambda streams: ["chunked=1"]),
+  'single-paced': ("one 320 kbit/s stream", lambda streams: ["rate=40000&burst=4096"]),
+  'concurrent-paced': (
+    "many 1 Mbit/s streams", lambda streams: ["rate=125000&id=%d" % index for index in range(streams)]
+  ),
+  'concurrent-unpaced': (
+    "a few unpaced streams", lambda streams: ["id=%d" % index for index in range(min(streams, 8))]
+  ),
+  'resilience': (
+    "a 4 Mbit/s finite stream which stalls for 1.5 s every 2 s and drops its connection every 1.5 MB (resumed with"
+    " Range)", lambda streams: ["bytes=1000000000&rate=500000&stall_every=2&stall=1.5&drop_after=1500000"]
+  ),
+}
+
+def startServer ():
+  # the stream server in its own process (so its CPU isn't counted as the catcher's); returns it and its base URL
+  server = subprocess.Popen([sys.executable, SERVER, "--port", "0"], stdout=subprocess.PIPE, universal_newlines=True)
+  url = server.stdout.readline().split()[-1]
+  return server, url
+
+def runCatcher (args, directory):
+  # run the catcher in a fresh interpreter which reports its own run time, CPU time and peak RSS (in KiB) on exit
+  argv = [CATCHER] + args
+
+  if resource is None:
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable] + argv, cwd=directory, stderr=subprocess.PIPE, universal_newlines=True)
+    return result, { 'elapsed_s': time.perf_counter() - started }
+
+  code = (
+    "import resource, runpy, sys, time\n"
+    "sys.argv = %r\n"
+    "started = time.monotonic()\n"
+    "try:\n"
+    "  runpy.run_path(%r, run_name='__main__')\n"
+    "finally:\n"
+    "  usage = resource.getrusage(resource.RUSAGE_SELF)\n"
+    "  sys.stderr.write('\\nBENCHMARK %%f %%f %%d\\n' %% (\n"
+    "    time.monotonic() - started, usage.ru_utime + usage.ru_stime, usage.ru_maxrss\n"
+    "  ))\n"
+  ) % (argv, CATCHER)
+
+  result = subprocess.run([sys.executable, "-c", code], cwd=directory, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+  line = [line for line in result.stderr.splitlines() if line.startswith("BENCHMARK ")][-1].split()
+
+  return result, { 'elapsed_s': float(line[1]), 'cpu_s': float(line[2]), 'peak_rss_kib': int(line[3]) }
+
+def readFinalStats (fileName):
+  # the last line written for each stream
+  streams = {}
+
+  with open(fileName) as statsFile:
+    for line in statsFile:
+      stream = json.loads(line)
+      streams[stream["file"]] = stream
+
+  return list(streams.values())
+
+def runScenario (scenario, baseURL, seconds, streams):
+  description, getQueries = SCENARIOS[scenario]
+  queries = getQueries(streams)
+  results = { 'description': description, 'streams': len(queries), 'seconds': seconds }
+
+  with tempfile.TemporaryDirectory() as directory:
+    statsFile = os.path.join(directory, "stats.jsonl")
+    args = ["--stats-file", statsFile, "--stats-interval", str(seconds * 2)]
+    fileNames = [os.path.join(directory, "stream%04d.bin" % index) for index in range(len(queries))]
+
+    if len(queries) == 1:
+      args += ["-t", str(seconds), "-u", "%sstream?%s" % (baseURL, queries[0]), "-f", fileNames[0]]
+    else:
+      jobFile = os.path.join(directory, "jobs.txt")
+
+      with open(jobFile, "w") as jobs:
+        for query, fileName in zip(queries, fileNames):
+          jobs.write("%s %sstream?%s %s\n" % (seconds, baseURL, query, fileName))
+
+      args += ["-j", jobFile]
+
+    result, usage = runCatcher(args, directory)
+    results.update(usage)
+    results['exit_status'] = result.returncode
+    stats = readFinalStats(statsFile)
+    received = sum(stream["bytes"] for stream in stats)
+    overruns = [stream["elapsed_s"] - seconds for stream in stats]
+
+    results.update({
+      'bytes': received,
+      'mb_per_s': round(received / usage['elapsed_s'] / 1e6, 2),
+      'dropped_bytes': sum(stream["dropped_bytes"] for stream in stats),
+      'buffer_high_water_max': max(stream["buffer_high_water"] for stream in stats),
+      'stalls': sum(stream["stalls"] for stream in stats),
+      'reconnection_attempts': sum(stream["reconnection_attempts"] for stream in stats),
+      'gap_s': round(sum(stream["gap_s"] for stream in stats), 3),
+      'deadline_overrun_s': {
+        'mean': round(sum(overruns) / len(overruns), 4),
+        'max': round(max(overruns), 4),
+        'process': round(usage['elapsed_s'] - seconds, 4),
+      },
+    })
+
+    if 'cpu_s' in usage:
+      results['cpu_percent'] = round(100 * usage['cpu_s'] / usage['elapsed_s'], 1)
+      results['cpu_ms_per_mb'] = round(1000 * usage['cpu_s'] / max(received / 1e6, 1e-9), 3)
+
+    # paced streams should have delivered their whole bitrate's worth
+    if scenario.endswith("-paced"):
+      rate = float(queries[0].split("rate=")[1].split("&")[0])
+      results['completeness_min'] = round(min(stream["bytes"] for stream in stats) / (rate * seconds), 3)
+
+    # resumed captures must still be exactly the body, byte for byte
+    if scenario == 'resilience':
+      results['intact'] = all(checkPattern(fileName) for fileName in fileNames if os.path.exists(fileName))
+
+  return results
+
+def main ():
+  parser = argparse.ArgumentParser(description="Benchmark pystreamcatcher against a local stream server")
+  parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                      help='scenario to run (may be repeated; default: all)')
+  parser.add_argument('--seconds', type=float, default=10, help='length of each capture (default: 10)')
+  parser.add_argument('--streams', type=int, default=50, help='streams in the concurrent scenarios (default: 50)')
+  parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+  args = parser.parse_args()
+
+  report = {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'pystreamcatcher': CATCHER,
+    'scenarios': dict()
+  }
+
+  server, baseURL = startServer()
+
+  try:
+    for scenario in args.scenario or sorted(SCENARIOS):
+      report['scenarios'][scenario] = runScenario(scenario, baseURL, args.seconds, args.streams)
+  finally:
+    server.terminate()
+    server.wait()
+
+  output = json.dumps(report, indent=2)
+
+  if args.output:
+    with open(args.output, 'w') as outputFile:
+      outputFile.write(output + "\n")
+  else:
+    print(output)
+
+if __name__ == "__main__":
+  main()
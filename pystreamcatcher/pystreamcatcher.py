@@ -1,30 +1,105 @@
 #!/usr/bin/env python
 
-from threading import Thread
+from bisect import bisect_left
+from collections import deque, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Thread
 from urllib.parse import urlparse
+import asyncio
+import io
+import json
+import mmap
 import os.path
+import signal
 import sys
 import time
+import socket
 import http.client
 
 _value_stream_url = None
 _value_output_file = None
 _value_timeout = None
+_value_job_file = None
+_value_buffer_size = None
+_value_segment_size = None
+_value_segment_time = None
+_value_stall_timeout = None
+_value_stats_file = None
+_value_stats_port = None
+_value_stats_interval = None
+_values_stream_url = []
+_values_output_file = []
+_values_timeout = []
 keepGoing = True
 
+# one stream to record: for how many seconds, from where, and into which file
+Job = namedtuple("Job", ["seconds", "url", "filename"])
+
+# reads start at MIN_CHUNK_SIZE bytes and adapt to the stream's bitrate between the two sizes
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# how long a stream may send nothing before it counts as stalled and is reconnected
+DEFAULT_STALL_TIMEOUT = 10
+
+# reconnection attempts back off exponentially, from the first delay up to the second
+MIN_RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+
+# each stream's received data waits in a ring buffer of this size (in MiB, unless given) for its disk writer, which
+# writes it out WRITE_SIZE bytes at a time, or after FLUSH_INTERVAL seconds if less than that arrives
+DEFAULT_BUFFER_SIZE = 8
+WRITE_SIZE = 256 * 1024
+FLUSH_INTERVAL = 0.25
+
+# metrics: a read which waited at least STALL_THRESHOLD seconds for data counts as a stall; the current bitrate is
+# averaged over the last RATE_WINDOW seconds; latencies are counted into buckets with these upper bounds (in seconds)
+DEFAULT_STATS_INTERVAL = 5
+STALL_THRESHOLD = 1.0
+RATE_WINDOW = 5
+LATENCY_BOUNDS = [
+  0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0
+]
+
+MAX_LINE_LENGTH = 1024
+MAX_HEAD_SIZE = 64 * 1024
+
 def stderr (someString = ""):
   print(someString, file=sys.stderr)
 
 def printUsageString ():
   stderr("Usage: %s <mandatory_options>" % sys.argv[0])
+  stderr("       %s -j <job_file>" % sys.argv[0])
   stderr("Description: %s records the contents of an HTTP stream into a file for an arbitrary length of time" % sys.argv[0])
   stderr()
   stderr("Mandatory arguments to long options are mandatory for short options too.")
   stderr("  -t, --time <seconds>       [MANDATORY] capture stream for <seconds> number of seconds")
   stderr("  -u, --url  <URL>           [MANDATORY] capture from the specified <URL>")
   stderr("  -f, --file <filename>      [MANDATORY] save the captured stream into <filename>")
+  stderr("  -j, --jobs <filename>      record every stream listed in <filename> at once, one \"<seconds> <URL>")
+  stderr("                             <filename>\" per line (blank lines and lines starting with # are ignored)")
+  stderr("  -b, --buffer <MiB>         buffer up to <MiB> of each stream in memory ahead of the disk (default: %d);"
+         % DEFAULT_BUFFER_SIZE)
+  stderr("                             whatever arrives while the buffer is full is dropped, and reported")
+  stderr("      --segment-size <MiB>   split each capture into files of <MiB> each, named <file>.0000<ext> etc.")
+  stderr("      --segment-time <seconds>")
+  stderr("                             split each capture into files of (about) <seconds> each, as above")
+  stderr("      --stall-timeout <seconds>")
+  stderr("                             reconnect to a stream which sends nothing for <seconds> (default: %d)"
+         % DEFAULT_STALL_TIMEOUT)
+  stderr("      --stats-file <filename>")
+  stderr("                             append every stream's metrics to <filename> as JSON lines, periodically")
+  stderr("      --stats-port <port>    serve every stream's current metrics as JSON on http://127.0.0.1:<port>/")
+  stderr("      --stats-interval <seconds>")
+  stderr("                             how often to append to the stats file (default: %d)" % DEFAULT_STATS_INTERVAL)
   stderr("  -h, -?, --help             display this help message and then exit")
   stderr()
+  stderr("Dropped or stalled connections are reconnected (resuming where they left off, where the server allows)")
+  stderr("until the capture time is up; the gaps are logged.")
+  stderr()
+  stderr("-u and -f may be repeated (in pairs) to record several streams at once; -t is then given either once, for")
+  stderr("all of them, or once per stream.")
+  stderr()
   stderr("Exit status:")
   stderr(" 0  if OK,")
   stderr(" 1  if not OK (further explanation [usually] provided).")
@@ -45,16 +120,26 @@ def printHelpExit ():
   exit(0)
 
 def processArgs ():
-  global _value_stream_url, _value_output_file, _value_timeout
+  global _value_stream_url, _value_output_file, _value_timeout, _value_job_file
+  global _value_buffer_size, _value_segment_size, _value_segment_time, _value_stall_timeout
+  global _value_stats_file, _value_stats_port, _value_stats_interval
   _flag_skip_next_arg = False
 
   if len(sys.argv) < 2:
     die("You must pass at least one file as an argument")
   
   possibleArgs = [
-    { "required": True,  "possibleOption": ("-t", "--time"),       "valueReference": "_value_timeout" },
-    { "required": True,  "possibleOption": ("-u", "--url"),        "valueReference": "_value_stream_url" },
-    { "required": True,  "possibleOption": ("-f", "--file"),       "valueReference": "_value_output_file" },
+    { "required": True,  "possibleOption": ("-t", "--time"),       "valueReference": "_value_timeout",     "listReference": "_values_timeout" },
+    { "required": True,  "possibleOption": ("-u", "--url"),        "valueReference": "_value_stream_url",  "listReference": "_values_stream_url" },
+    { "required": True,  "possibleOption": ("-f", "--file"),       "valueReference": "_value_output_file", "listReference": "_values_output_file" },
+    { "required": False, "possibleOption": ("-j", "--jobs"),       "valueReference": "_value_job_file" },
+    { "required": False, "possibleOption": ("-b", "--buffer"),     "valueReference": "_value_buffer_size" },
+    { "required": False, "possibleOption": ("--segment-size",),    "valueReference": "_value_segment_size" },
+    { "required": False, "possibleOption": ("--segment-time",),    "valueReference": "_value_segment_time" },
+    { "required": False, "possibleOption": ("--stall-timeout",),   "valueReference": "_value_stall_timeout" },
+    { "required": False, "possibleOption": ("--stats-file",),      "valueReference": "_value_stats_file" },
+    { "required": False, "possibleOption": ("--stats-port",),      "valueReference": "_value_stats_port" },
+    { "required": False, "possibleOption": ("--stats-interval",),  "valueReference": "_value_stats_interval" },
     { "required": False, "possibleOption": ("-h", "-?", "--help"), "valueReference": None, "argFunction": printHelpExit },
   ]
   
@@ -72,6 +157,8 @@ def processArgs ():
         if possibleArg["valueReference"] is not None:
           _flag_skip_next_arg = True
           globals()[possibleArg["valueReference"]] = sys.argv[index + 1]
+        if "listReference" in possibleArg:
+          globals()[possibleArg["listReference"]].append(sys.argv[index + 1])
         if "argFunction" in possibleArg and possibleArg["argFunction"] is not None:
           possibleArg["argFunction"]()
           
@@ -81,43 +168,1166 @@ def processArgs ():
     if noneMatched:
       pass #Note: implement this block for default argument processing
 
+  # a job file stands in for the mandatory options
+  if _value_job_file is not None:
+    return
+
   for arg in possibleArgs:
     if arg["required"] and "valueReference" in arg:
       if globals()[arg["valueReference"]] is None:
         die("you must pass the %s option" % str(arg["possibleOption"]))
+
+  if len(_values_stream_url) != len(_values_output_file):
+    die("the -u and -f options must be given in pairs")
+
+  if len(_values_timeout) not in (1, len(_values_stream_url)):
+    die("the -t option must be given once, or once per stream")
+
+def readJobFile (fileName):
+  jobs = []
+
+  try:
+    with open(fileName) as jobFile:
+      for lineNumber, line in enumerate(jobFile, 1):
+        line = line.strip()
+
+        if not line or line.startswith("#"):
+          continue
+
+        fields = line.split(None, 2)
+
+        if len(fields) != 3:
+          die("%s line %d: expected \"<seconds> <URL> <filename>\"" % (fileName, lineNumber))
+
+        jobs.append(Job(fields[0], fields[1], fields[2]))
+  except OSError as error:
+    die("cannot read the job file: %s" % error)
+
+  return jobs
+
+def getJobs ():
+  if _value_job_file is not None:
+    jobs = readJobFile(_value_job_file)
+  else:
+    timeouts = _values_timeout * len(_values_stream_url) if len(_values_timeout) == 1 else _values_timeout
+    jobs = [Job(*fields) for fields in zip(timeouts, _values_stream_url, _values_output_file)]
+
+  if not jobs:
+    die("there are no streams to record")
+
+  for job in jobs:
+    try:
+      if float(job.seconds) <= 0:
+        raise ValueError()
+    except ValueError:
+      die("%r is not a number of seconds" % job.seconds)
+
+    # a bad URL would otherwise only fail once its capture starts, taking any other streams down with it
+    try:
+      parsedURL = urlparse(job.url)
+
+      # reading the port raises ValueError for one that isn't a number from 0 to 65535
+      if parsedURL.scheme != "http" or not parsedURL.hostname or parsedURL.port == 0:
+        raise ValueError()
+    except ValueError:
+      die("%r is not an http:// URL" % job.url)
+
+  fileNames = [job.filename for job in jobs]
+
+  if len(set(fileNames)) != len(fileNames):
+    die("each stream needs its own output file")
+
+  return [job._replace(seconds=float(job.seconds)) for job in jobs]
+
+def positiveNumber (value, option):
+  try:
+    number = float(value)
+
+    if number <= 0:
+      raise ValueError()
+  except ValueError:
+    die("the %s option needs a positive number, not %r" % (option, value))
+
+  return number
+
+def getWriterOptions ():
+  # the DiskWriter settings given on the command line
+  options = { "bufferSize": DEFAULT_BUFFER_SIZE * 1024 * 1024, "segmentSize": None, "segmentTime": None }
+
+  if _value_buffer_size is not None:
+    options["bufferSize"] = int(positiveNumber(_value_buffer_size, "--buffer") * 1024 * 1024)
+
+  if _value_segment_size is not None:
+    options["segmentSize"] = int(positiveNumber(_value_segment_size, "--segment-size") * 1024 * 1024)
+
+  if _value_segment_time is not None:
+    options["segmentTime"] = positiveNumber(_value_segment_time, "--segment-time")
+
+  return options
+
+def getStallTimeout ():
+  if _value_stall_timeout is None:
+    return DEFAULT_STALL_TIMEOUT
+
+  return positiveNumber(_value_stall_timeout, "--stall-timeout")
+
+def getMetricsReporter (streams):
+  # a MetricsReporter for the --stats-* options, or None if no metrics were asked for
+  if _value_stats_file is None and _value_stats_port is None:
+    return None
+
+  interval = DEFAULT_STATS_INTERVAL
+
+  if _value_stats_interval is not None:
+    interval = positiveNumber(_value_stats_interval, "--stats-interval")
+
+  port = None
+
+  if _value_stats_port is not None:
+    if not _value_stats_port.isdigit() or not 0 < int(_value_stats_port) < 65536:
+      die("the --stats-port option needs a port number, not %r" % _value_stats_port)
+
+    port = int(_value_stats_port)
+
+  try:
+    return MetricsReporter(streams, _value_stats_file, port, interval)
+  except OSError as error:
+    die("cannot start reporting metrics: %s" % error)
+
+def outputFileName (fileName, segment):
+  # where a capture (or, when captures are split, one segment of it) goes
+  if segment is None:
+    return fileName
+
+  root, extension = os.path.splitext(fileName)
+  return "%s.%04d%s" % (root, segment, extension)
+
+def log (url, message):
+  stderr("%s %s: %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), url, message))
+
+def describeError (error):
+  return str(error) or error.__class__.__name__
+
+def requestTarget (parsedURL):
+  # the path and query to ask the server for
+  return (parsedURL.path or "/") + ("?" + parsedURL.query if parsedURL.query else "")
     
 
+class BodyDecoder:
+  """ Tracks where an HTTP response body ends (Content-Length, the last chunk, or the connection closing) and strips
+  chunked transfer encoding framing out of received data in place """
+
+  def __init__ (self, chunked, length):
+    self.chunked = chunked
+    self.remaining = None if chunked else length
+    self.chunkLeft = 0
+    self.header = bytearray()
+    self.done = self.remaining == 0
+
+  def decode (self, view, count):
+    """ Turns the count bytes received at the start of view into body bytes at the start of view; returns how
+    many there are (possibly none, when the bytes were all framing) """
+    if self.remaining is not None:
+      count = min(count, self.remaining)
+      self.remaining -= count
+      self.done = self.remaining == 0
+
+    if not self.chunked:
+      return count
+
+    # strip the chunk framing out of view[:count], moving chunk data down over it
+    position = kept = 0
+
+    while position < count and not self.done:
+      if self.chunkLeft > 0:
+        size = min(self.chunkLeft, count - position)
+
+        if kept != position:
+          view[kept:kept + size] = view[position:position + size]
+
+        kept += size
+        position += size
+        self.chunkLeft -= size
+        continue
+
+      # framing: the CRLF ending the previous chunk's data, then "<hex size>[;extensions]" CRLF
+      piece = bytes(view[position:min(count, position + MAX_LINE_LENGTH)])
+      newline = piece.find(b"\n")
+
+      if newline < 0:
+        self.header += piece
+        position += len(piece)
+
+        if len(self.header) > MAX_LINE_LENGTH:
+          raise http.client.LineTooLong("chunk size")
+
+        continue
+
+      self.header += piece[:newline + 1]
+      position += newline + 1
+      line = bytes(self.header).strip()
+      self.header.clear()
+
+      if not line:
+        continue
+
+      try:
+        self.chunkLeft = int(line.split(b";", 1)[0], 16)
+      except ValueError:
+        raise http.client.HTTPException("invalid chunk size line %r" % line)
+
+      # the last chunk; any trailers are of no interest
+      self.done = self.chunkLeft == 0
+
+    return kept
+
+
+class Reconnector:
+  """ What it takes to pick a capture back up after its connection drops: how far into the stream it got, whether
+  the server can resume from there (a Range request), and the exponential backoff between attempts.  Gaps in the
+  capture are logged as they open and close """
+
+  def __init__ (self, url):
+    self.url = url
+    self.offset = 0
+    self.rangeOffset = None
+    self.ranges = False
+    self.validator = None
+    self.delay = MIN_RECONNECT_DELAY
+    self.lostAt = None
+    self.connections = 0
+    self.attempts = 0
+    self.gapTime = 0.0
+    self.bytesReceived = 0
+
+  def requestHeaders (self):
+    headers = { "User-Agent": "pystreamcatcher" }
+    self.rangeOffset = None
+
+    if self.ranges and self.offset > 0:
+      self.rangeOffset = self.offset
+      headers["Range"] = "bytes=%d-" % self.offset
+
+      # resume only if it's still the same thing being served
+      if self.validator is not None:
+        headers["If-Range"] = self.validator
+
+    return headers
+
+  def connected (self, status, headers):
+    """ Checks the response to a (re)connection, raising HTTPException if it isn't something to record """
+    if status == 206 and self.rangeOffset is not None:
+      contentRange = headers.get("Content-Range", "")
+
+      try:
+        start = int(contentRange.split()[1].split("-")[0])
+      except (IndexError, ValueError):
+        start = None
+
+      if start != self.rangeOffset:
+        self.ranges = False
+        raise http.client.HTTPException("asked to resume at byte %d, got %r" % (self.rangeOffset, contentRange))
+
+      resumed = "resumed at byte %d" % start
+    elif status == 200:
+      resumed = "reconnected (the server ignored the Range request: the stream started over)" if (
+        self.rangeOffset is not None) else "reconnected"
+      self.offset = 0
+    else:
+      raise http.client.HTTPException("unexpected response status %d" % status)
+
+    self.ranges = status == 206 or headers.get("Accept-Ranges", "").strip().lower() == "bytes"
+    self.validator = headers.get("ETag")
+
+    # If-Range takes a strong ETag, or failing that, a modification date
+    if self.validator is None or self.validator.startswith("W/"):
+      self.validator = headers.get("Last-Modified")
+
+    self.connections += 1
+
+    if self.lostAt is not None:
+      gap = time.monotonic() - self.lostAt
+      self.gapTime += gap
+      self.lostAt = None
+      log(self.url, "%s after a %.1f s gap" % (resumed, gap))
+
+  def received (self, count):
+    self.offset += count
+    self.bytesReceived += count
+    self.delay = MIN_RECONNECT_DELAY
+
+  def lost (self, reason):
+    """ Notes a dropped connection (or failed attempt at one); returns how long to wait before trying again """
+    if self.lostAt is None and self.connections == 0:
+      self.lostAt = time.monotonic()
+      log(self.url, "cannot connect: %s" % reason)
+    elif self.lostAt is None:
+      self.lostAt = time.monotonic()
+      log(self.url, "connection lost after %d bytes: %s" % (self.bytesReceived, reason))
+    else:
+      log(self.url, "reconnection failed: %s" % reason)
+
+    self.attempts += 1
+    delay = self.delay
+    self.delay = min(delay * 2, MAX_RECONNECT_DELAY)
+    return delay
+
+  def finish (self):
+    if self.lostAt is not None:
+      self.gapTime += time.monotonic() - self.lostAt
+      self.lostAt = None
+      log(self.url, "the capture ended during a gap")
+
+  def report (self):
+    return "%s: %d reconnection attempts, %.1f s of gaps" % (self.url, self.attempts, self.gapTime)
+
+def stopCapturing (signum, frame):
+  # SIGINT handler: the captures stop at their next read, keeping what was recorded (a KeyboardInterrupt raised in
+  # Thread.join() would leave the thread looking stopped while it was still writing out)
+  global keepGoing
+  keepGoing = False
+
+def finishCapture (url, writer, reconnector):
+  # report on a finished capture; returns whether it counts as a success
+  stderr(writer.report())
+
+  if reconnector.attempts:
+    stderr(reconnector.report())
+
+  if writer.error is not None:
+    stderr("ERROR: cannot write %s: %s" % (writer.fileName, writer.error))
+    return False
+
+  if reconnector.bytesReceived == 0:
+    stderr("ERROR: %s: nothing was received" % url)
+    return False
+
+  return True
+
+
+class StreamReader:
+  """ Reads an HTTP response body straight from the socket into a caller's buffer, decoding chunked transfer
+  encoding in place, so the receive loop never allocates per read """
+
+  def __init__ (self, response, sock):
+    self.sock = sock
+    self.decoder = BodyDecoder(response.chunked, response.length)
+
+    # whatever http.client buffered while parsing the headers is the start of the body; take it without blocking,
+    # then read the socket directly (a timeout on the raw socket is recoverable, unlike one on the response's file)
+    sock.setblocking(False)
+    self.pending = response.fp.read1(MAX_CHUNK_SIZE)
+    self.timeout = None
+
+  def readinto (self, view, timeout):
+    """ Puts the next body bytes at the start of view and returns how many; 0 at the end of the body (or of the
+    connection), None if nothing arrived within timeout seconds """
+    # only touch the socket's timeout when it changes (which is only ever as the deadline closes in)
+    if timeout != self.timeout:
+      self.sock.settimeout(timeout)
+      self.timeout = timeout
+
+    while not self.decoder.done:
+      if self.decoder.remaining is not None:
+        view = view[:self.decoder.remaining]
+
+      if self.pending:
+        count = min(len(self.pending), len(view))
+        view[:count] = self.pending[:count]
+        self.pending = self.pending[count:]
+      else:
+        try:
+          count = self.sock.recv_into(view)
+        except socket.timeout:
+          return None
+
+        if count == 0:
+          break
+
+      count = self.decoder.decode(view, count)
+
+      # a read holding nothing but chunk framing isn't the end of the stream
+      if count > 0:
+        return count
+
+    return 0
+
+
+def adaptChunkSize (chunkSize, count):
+  # grow reads while they come back full (a fast stream: fewer, larger syscalls and writes), and shrink them when
+  # they come back mostly empty (a slow stream: less buffer touched per read)
+  if count == chunkSize:
+    return min(chunkSize * 2, MAX_CHUNK_SIZE)
+
+  if count < chunkSize // 4:
+    return max(chunkSize // 2, MIN_CHUNK_SIZE)
+
+  return chunkSize
+
+
+class Histogram:
+  """ Counts of observed durations, bucketed by LATENCY_BOUNDS """
+
+  def __init__ (self):
+    self.counts = [0] * (len(LATENCY_BOUNDS) + 1)
+    self.total = 0.0
+    self.maximum = 0.0
+
+  def record (self, seconds):
+    self.counts[bisect_left(LATENCY_BOUNDS, seconds)] += 1
+    self.total += seconds
+    self.maximum = max(self.maximum, seconds)
+
+  def snapshot (self):
+    counts = list(self.counts)
+    count = sum(counts)
+    buckets = { "le_%g" % (bound * 1000): bucket for bound, bucket in zip(LATENCY_BOUNDS, counts) }
+    buckets["le_inf"] = counts[-1]
+
+    return {
+      "count": count,
+      "mean_ms": round(self.total / count * 1000, 3) if count else None,
+      "max_ms": round(self.maximum * 1000, 3),
+      "buckets_ms": buckets,
+    }
+
+
+class StreamMetrics:
+  """ Live instrumentation for one capture: what it received and how fast, how long reads waited, its stalls, and
+  (from its DiskWriter and Reconnector, once attached) disk write latency, buffer use, and reconnections """
+
+  def __init__ (self, url, fileName):
+    self.url = url
+    self.fileName = fileName
+    self.started = time.monotonic()
+    self.ended = None
+    self.bytes = 0
+    self.reads = 0
+    self.lastRead = None
+    self.readLatency = Histogram()
+    self.writeLatency = Histogram()
+    self.stalls = 0
+    self.stallTime = 0.0
+    self.writer = None
+    self.reconnector = None
+    self.finished = False
+
+    # bytes received per whole second, for the current bitrate
+    self.second = int(self.started)
+    self.secondBytes = 0
+    self.recent = deque(maxlen=RATE_WINDOW + 1)
+
+  def begin (self, writer, reconnector):
+    """ Starts the clock on the capture, whose DiskWriter and Reconnector fill in the rest of the metrics """
+    self.started = time.monotonic()
+    self.second = int(self.started)
+    self.writer = writer
+    self.reconnector = reconnector
+
+  def end (self):
+    self.ended = time.monotonic()
+    self.finished = True
+
+  def read (self, count, waited):
+    """ Records a read which returned count bytes after waiting waited seconds """
+    now = time.monotonic()
+    self.bytes += count
+    self.reads += 1
+    self.lastRead = now
+    self.readLatency.record(waited)
+
+    if waited >= STALL_THRESHOLD:
+      self.stalled(waited)
+
+    second = int(now)
+
+    if second != self.second:
+      self.recent.append((self.second, self.secondBytes))
+      self.second = second
+      self.secondBytes = 0
+
+    self.secondBytes += count
+
+  def stalled (self, seconds):
+    self.stalls += 1
+    self.stallTime += seconds
+
+  def snapshot (self):
+    now = self.ended if self.ended is not None else time.monotonic()
+    elapsed = now - self.started
+
+    # the bytes from the whole seconds within the window, and the current second's
+    since = int(now) - RATE_WINDOW
+    recent = sum(count for second, count in list(self.recent) if second >= since)
+    recent += self.secondBytes if self.second >= since else 0
+    window = min(now - since, elapsed)
+
+    metrics = {
+      "url": self.url,
+      "file": self.fileName,
+      "finished": self.finished,
+      "elapsed_s": round(elapsed, 3),
+      "bytes": self.bytes,
+      "bitrate_bps": round(recent * 8 / window) if window > 0 else 0,
+      "average_bitrate_bps": round(self.bytes * 8 / elapsed) if elapsed > 0 else 0,
+      "idle_s": round(now - (self.lastRead or self.started), 3),
+      "reads": self.reads,
+      "read_latency": self.readLatency.snapshot(),
+      "stalls": self.stalls,
+      "stall_s": round(self.stallTime, 3),
+      "disk_write_latency": self.writeLatency.snapshot(),
+    }
+
+    if self.writer is not None:
+      metrics.update({
+        "bytes_written": self.writer.bytesWritten,
+        "buffer_size": self.writer.capacity,
+        "buffer_high_water": self.writer.highWater,
+        "dropped_bytes": self.writer.droppedBytes,
+        "overflows": self.writer.overflows,
+      })
+
+    if self.reconnector is not None:
+      metrics.update({
+        "connected": self.reconnector.connections > 0 and self.reconnector.lostAt is None,
+        "reconnection_attempts": self.reconnector.attempts,
+        "gap_s": round(self.reconnector.gapTime, 3),
+      })
+
+    return metrics
+
+
+class MetricsHandler (BaseHTTPRequestHandler):
+  def do_GET (self):
+    body = json.dumps(self.server.reporter.snapshot()).encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message (self, format, *args):
+    pass
+
+
+class MetricsReporter (Thread):
+  """ Emits every capture's metrics: every interval seconds (and once more at the end) as JSON lines appended to a
+  stats file, and on request as a JSON document served on localhost """
+
+  def __init__ (self, streams, fileName, port, interval):
+    self.streams = streams
+    self.fileName = fileName
+    self.interval = interval
+    self.stopping = Event()
+    self.server = None
+
+    if port is not None:
+      self.server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+      self.server.daemon_threads = True
+      self.server.reporter = self
+      Thread(target=self.server.serve_forever, daemon=True).start()
+
+    Thread.__init__(self, daemon=True)
+
+  def snapshot (self):
+    return { "time": time.time(), "streams": [stream.snapshot() for stream in self.streams] }
+
+  def emit (self):
+    if self.fileName is None:
+      return
+
+    snapshot = self.snapshot()
+
+    try:
+      with open(self.fileName, "a") as statsFile:
+        for stream in snapshot["streams"]:
+          statsFile.write(json.dumps(dict(stream, time=snapshot["time"])) + "\n")
+    except OSError as error:
+      stderr("ERROR: cannot write the stats file: %s" % error)
+
+  def run (self):
+    while not self.stopping.wait(self.interval):
+      self.emit()
+
+  def stop (self):
+    self.stopping.set()
+
+    if self.is_alive():
+      self.join()
+
+    self.emit()
+
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+
+
+class DiskWriter (Thread):
+  """ Writes one capture to disk from a ring buffer, so the network side never waits on the disk: the reader
+  receives straight into free space from reserve() and hands it over with commit(), and this thread writes what's
+  waiting in large, coalesced writes (optionally splitting the capture into segments by size or time).  When the
+  buffer is full the reader drops data rather than stall; how full the buffer got, and what was dropped, is kept
+  for report() """
+
+  def __init__ (self, fileName, bufferSize, segmentSize = None, segmentTime = None, metrics = None):
+    self.fileName = fileName
+    self.metrics = metrics
+    self.capacity = bufferSize
+    # anonymous memory is only paged in as the ring first goes round, so a slow stream doesn't cost a whole buffer
+    # up front
+    self.view = memoryview(mmap.mmap(-1, bufferSize))
+    self.writeSize = min(WRITE_SIZE, max(bufferSize // 2, 1))
+    self.segmentSize = segmentSize
+    self.segmentTime = segmentTime
+    self.segment = 0 if segmentSize or segmentTime else None
+
+    # produced and consumed byte counts since the start; the data waiting to be written is the difference
+    self.head = 0
+    self.tail = 0
+    self.closing = False
+    self.ready = Condition()
+
+    self.highWater = 0
+    self.droppedBytes = 0
+    self.overflows = 0
+    self.overflowing = False
+    self.bytesWritten = 0
+    self.writes = 0
+    self.error = None
+
+    # open the first file here, so a file that can't be created is reported before anything is received
+    self.openSegment()
+    Thread.__init__(self, daemon=True)
+
+  def openSegment (self):
+    self.fileHandle = open(outputFileName(self.fileName, self.segment), "xb", buffering=0)
+    self.segmentBytes = 0
+    self.segmentStarted = time.monotonic()
+
+  def reserve (self, limit):
+    """ Returns up to limit bytes of contiguous free space to receive into, or None if the buffer is full """
+    with self.ready:
+      free = self.capacity - (self.head - self.tail)
+
+    offset = self.head % self.capacity
+    size = min(limit, free, self.capacity - offset)
+    return self.view[offset:offset + size] if size > 0 else None
+
+  def commit (self, count):
+    """ Hands over count bytes received into the space from reserve() """
+    with self.ready:
+      self.head += count
+      waiting = self.head - self.tail
+      self.highWater = max(self.highWater, waiting)
+      self.overflowing = False
+
+      if waiting >= self.writeSize:
+        self.ready.notify()
+
+  def drop (self, count):
+    """ Accounts for count bytes which arrived while the buffer was full """
+    with self.ready:
+      self.droppedBytes += count
+
+      if not self.overflowing:
+        self.overflowing = True
+        self.overflows += 1
+
+  def write (self, data):
+    """ Copies data into the buffer (for the odd bytes which weren't received into it directly) """
+    data = memoryview(data)
+
+    while len(data) > 0:
+      view = self.reserve(len(data))
+
+      if view is None:
+        self.drop(len(data))
+        return
+
+      view[:] = data[:len(view)]
+      self.commit(len(view))
+      data = data[len(view):]
+
+  def close (self):
+    """ Writes out whatever is still waiting, then closes the file """
+    with self.ready:
+      self.closing = True
+      self.ready.notify()
+
+    if self.is_alive():
+      self.join()
+    else:
+      self.fileHandle.close()
+
+  def run (self):
+    try:
+      while True:
+        with self.ready:
+          flushAt = time.monotonic() + FLUSH_INTERVAL
+
+          while self.head - self.tail < self.writeSize and not self.closing and time.monotonic() < flushAt:
+            self.ready.wait(max(flushAt - time.monotonic(), 0))
+
+          start, end, closing = self.tail, self.head, self.closing
+
+        self.writeOut(start, end)
+
+        if closing:
+          with self.ready:
+            if self.head == self.tail:
+              break
+    except OSError as error:
+      self.error = error
+    finally:
+      self.fileHandle.close()
+
+  def writeOut (self, start, end):
+    while start < end:
+      if self.segment is not None and self.segmentBytes > 0 and (
+        (self.segmentSize and self.segmentBytes >= self.segmentSize) or
+        (self.segmentTime and time.monotonic() - self.segmentStarted >= self.segmentTime)
+      ):
+        self.fileHandle.close()
+        self.segment += 1
+        self.openSegment()
+
+      stop = end if not self.segmentSize else min(end, start + self.segmentSize - self.segmentBytes)
+      self.writeAll(self.slices(start, stop))
+      self.segmentBytes += stop - start
+      self.bytesWritten += stop - start
+      start = stop
+
+      with self.ready:
+        self.tail = start
+
+  def slices (self, start, stop):
+    # the buffer contents between two byte counts, as one piece, or two where they wrap around the end
+    offset = start % self.capacity
+    first = min(stop - start, self.capacity - offset)
+    pieces = [self.view[offset:offset + first]]
+
+    if first < stop - start:
+      pieces.append(self.view[:stop - start - first])
+
+    return pieces
+
+  def writeAll (self, pieces):
+    # one system call for both pieces where there's writev; either way, keep going after a partial write
+    while pieces:
+      started = time.monotonic()
+
+      if hasattr(os, "writev"):
+        written = os.writev(self.fileHandle.fileno(), pieces)
+      else:
+        written = self.fileHandle.write(pieces[0])
+
+      self.writes += 1
+
+      if self.metrics is not None:
+        self.metrics.writeLatency.record(time.monotonic() - started)
+
+      while pieces and written >= len(pieces[0]):
+        written -= len(pieces[0])
+        pieces.pop(0)
+
+      if pieces:
+        pieces[0] = pieces[0][written:]
+
+  def report (self):
+    message = "%s: wrote %d bytes in %d writes" % (self.fileName, self.bytesWritten, self.writes)
+
+    if self.segment is not None:
+      message += " to %d segments" % (self.segment + 1)
+
+    message += "; buffer high-water mark %d of %d bytes (%.0f%%)" % (
+      self.highWater, self.capacity, 100.0 * self.highWater / self.capacity
+    )
+
+    if self.droppedBytes:
+      message += "; DROPPED %d bytes in %d overflows" % (self.droppedBytes, self.overflows)
+
+    return message
+
+
 class StreamThread (Thread):
-  def __init__ (self, streamURL, fileName):
+  def __init__ (self, streamURL, fileName, deadline, writerOptions, stallTimeout, metrics):
     self.streamURL = streamURL
     self.filename = fileName
+    self.deadline = deadline
+    self.writerOptions = writerOptions
+    self.stallTimeout = stallTimeout
+    self.metrics = metrics
+    self.overflow = None
+    self.chunkSize = MIN_CHUNK_SIZE
+    self.succeeded = False
     Thread.__init__(self)
 
   def run (self):
-     parsedURL = urlparse(self.streamURL)
-     hostname = parsedURL.netloc
-     streamPath = parsedURL.path
-     conn = http.client.HTTPConnection(hostname)
-     conn.request("GET", streamPath)
-     response = conn.getresponse()
-
-     if os.path.exists(self.filename):
-       sys.stderr.write("ERROR: the file/folder %s already exists\n" % self.filename)
-       exit(1)
-
-     with open(self.filename, "wb") as fileHandle:
-       while keepGoing:
-         if response is not None:
-           data = response.read(1024)
-
-           if len(data) > 0:
-             fileHandle.write(data)
-             #print("Streamer: wrote 1024 bytes... %s" % str(data))
-         else:
-           break
-
-processArgs()
-streamer = StreamThread(_value_stream_url, _value_output_file)
-streamer.start()
-time.sleep(int(_value_timeout))
-keepGoing = False
+    try:
+      writer = DiskWriter(self.filename, metrics=self.metrics, **self.writerOptions)
+    except OSError as error:
+      sys.stderr.write("ERROR: cannot create %s: %s\n" % (self.filename, error))
+      return
+
+    reconnector = Reconnector(self.streamURL)
+    self.metrics.begin(writer, reconnector)
+    writer.start()
+
+    try:
+      while keepGoing and writer.error is None:
+        try:
+          reason = self.capture(writer, reconnector)
+        except (OSError, http.client.HTTPException) as error:
+          reason = describeError(error)
+
+        remaining = self.deadline - time.monotonic()
+
+        if reason is None or remaining <= 0:
+          break
+
+        time.sleep(min(reconnector.lost(reason), remaining))
+    finally:
+      reconnector.finish()
+      writer.close()
+      self.metrics.end()
+
+    self.succeeded = finishCapture(self.streamURL, writer, reconnector)
+
+  def waitTime (self):
+    # how long any one wait on the network may take: long enough to tell a stall, but never past the deadline
+    return min(self.stallTimeout, self.deadline - time.monotonic())
+
+  def capture (self, writer, reconnector):
+    # one connection's worth of the capture; returns None when the capture is over (the deadline reached, or the
+    # whole body received), otherwise why the connection ended
+    if self.waitTime() <= 0:
+      return None
+
+    parsedURL = urlparse(self.streamURL)
+    conn = http.client.HTTPConnection(parsedURL.netloc, timeout=self.waitTime())
+
+    try:
+      conn.request("GET", requestTarget(parsedURL), headers=reconnector.requestHeaders())
+
+      # the connection drops its reference to the socket once a response that closes the connection arrives
+      sock = conn.sock
+      response = conn.getresponse()
+
+      try:
+        reconnector.connected(response.status, response.headers)
+        reader = StreamReader(response, sock)
+
+        while keepGoing and writer.error is None:
+          timeout = self.waitTime()
+
+          if timeout <= 0:
+            return None
+
+          view = writer.reserve(self.chunkSize)
+          dropping = view is None
+
+          # the writer has fallen behind by a whole buffer: keep the connection going, but the data is lost
+          if dropping:
+            if self.overflow is None:
+              self.overflow = memoryview(bytearray(MAX_CHUNK_SIZE))
+
+            view = self.overflow[:self.chunkSize]
+
+          started = time.monotonic()
+          count = reader.readinto(view, timeout)
+
+          if count is None:
+            if time.monotonic() >= self.deadline:
+              return None
+
+            self.metrics.stalled(time.monotonic() - started)
+            return "nothing received for %g s" % self.stallTimeout
+
+          if count == 0:
+            return None if reader.decoder.done else "the server closed the connection"
+
+          if dropping:
+            writer.drop(count)
+          else:
+            writer.commit(count)
+
+          reconnector.received(count)
+          self.metrics.read(count, time.monotonic() - started)
+
+          # reads cut short by the end of the buffer say nothing about the stream
+          if len(view) == self.chunkSize:
+            self.chunkSize = adaptChunkSize(self.chunkSize, count)
+
+        return None
+      finally:
+        response.close()
+        sock.close()
+    finally:
+      conn.close()
+
+
+class RecorderProtocol (asyncio.BufferedProtocol):
+  """ Records one stream on the event loop: the transport receives the response head into a small buffer of this
+  stream's own, and the body straight into its DiskWriter's ring buffer, where it's decoded in place """
+
+  def __init__ (self, writer, reconnector, metrics):
+    self.writer = writer
+    self.reconnector = reconnector
+    self.metrics = metrics
+    self.view = memoryview(bytearray(MIN_CHUNK_SIZE))
+    self.region = None
+    self.overflow = None
+    self.dropping = False
+    self.chunkSize = MIN_CHUNK_SIZE
+    self.head = bytearray()
+    self.decoder = None
+    self.transport = None
+    self.error = None
+    self.loop = asyncio.get_running_loop()
+    self.finished = self.loop.create_future()
+    self.lastActivity = self.loop.time()
+
+  def connection_made (self, transport):
+    self.transport = transport
+
+  def get_buffer (self, sizeHint):
+    # each read is bounded by the chunk size, so a fast stream takes no more than its share of the loop
+    if self.decoder is None:
+      self.region = self.view
+    else:
+      self.region = self.writer.reserve(self.chunkSize)
+      self.dropping = self.region is None
+
+      # the writer has fallen behind by a whole buffer: keep the connection going, but the data is lost
+      if self.dropping:
+        if self.overflow is None:
+          self.overflow = memoryview(bytearray(MAX_CHUNK_SIZE))
+
+        self.region = self.overflow[:self.chunkSize]
+
+    return self.region
+
+  def buffer_updated (self, count):
+    waited = self.loop.time() - self.lastActivity
+    self.lastActivity += waited
+
+    try:
+      if self.decoder is None:
+        count = self.parseHead(count)
+
+        if self.decoder is not None:
+          count = self.decoder.decode(self.view, count)
+          self.writer.write(self.view[:count])
+          self.reconnector.received(count)
+          self.metrics.read(count, waited)
+      else:
+        if len(self.region) == self.chunkSize:
+          self.chunkSize = adaptChunkSize(self.chunkSize, count)
+
+        count = self.decoder.decode(self.region, count)
+
+        if self.dropping:
+          self.writer.drop(count)
+        else:
+          self.writer.commit(count)
+
+        self.reconnector.received(count)
+        self.metrics.read(count, waited)
+    except (ValueError, http.client.HTTPException) as error:
+      self.error = error
+      self.transport.close()
+      return
+
+    if self.writer.error is not None or (self.decoder is not None and self.decoder.done):
+      self.transport.close()
+
+  def parseHead (self, count):
+    # collect the status line and headers; once they're complete, moves any body bytes which came with them to the
+    # start of the buffer and returns how many there are
+    self.head += self.view[:count]
+    end = self.head.find(b"\r\n\r\n")
+
+    if end < 0:
+      if len(self.head) > MAX_HEAD_SIZE:
+        raise http.client.HTTPException("the response head is too long")
+
+      return 0
+
+    body = self.head[end + 4:]
+    statusLine, _, headerLines = bytes(self.head[:end + 2]).partition(b"\r\n")
+    self.head = None
+    fields = statusLine.split(None, 2)
+
+    if len(fields) < 2 or not fields[0].startswith(b"HTTP/") or not fields[1].isdigit():
+      raise http.client.HTTPException("unexpected response %r" % statusLine.decode("latin-1"))
+
+    headers = http.client.parse_headers(io.BytesIO(headerLines))
+    self.reconnector.connected(int(fields[1]), headers)
+    chunked = "chunked" in headers.get("Transfer-Encoding", "").lower()
+    length = headers.get("Content-Length")
+    self.decoder = BodyDecoder(chunked, None if chunked or length is None else int(length))
+    self.view[:len(body)] = body
+    return len(body)
+
+  def connection_lost (self, error):
+    if self.error is None:
+      self.error = error
+
+    # (the future is cancelled if the capture was, while it waited for the connection to close)
+    if not self.finished.done():
+      self.finished.set_result(None)
+
+async def captureOnce (job, writer, reconnector, metrics, deadline, stallTimeout):
+  # one connection's worth of a capture; returns None when the capture is over (the deadline reached, or the whole
+  # body received), otherwise why the connection ended
+  loop = asyncio.get_running_loop()
+  timeout = min(stallTimeout, deadline - loop.time())
+
+  if timeout <= 0:
+    return None
+
+  parsedURL = urlparse(job.url)
+  transport, protocol = await asyncio.wait_for(
+    loop.create_connection(
+      lambda: RecorderProtocol(writer, reconnector, metrics), parsedURL.hostname, parsedURL.port or 80
+    ),
+    timeout
+  )
+
+  headers = reconnector.requestHeaders()
+  headers.update({ "Host": parsedURL.netloc, "Connection": "close" })
+  request = "GET %s HTTP/1.1\r\n%s\r\n" % (
+    requestTarget(parsedURL), "".join("%s: %s\r\n" % header for header in headers.items())
+  )
+  transport.write(request.encode("latin-1"))
+
+  try:
+    while not protocol.finished.done():
+      now = loop.time()
+      idle = now - protocol.lastActivity
+
+      if now >= deadline:
+        return None
+
+      if idle >= stallTimeout:
+        metrics.stalled(idle)
+        return "nothing received for %g s" % stallTimeout
+
+      await asyncio.wait([protocol.finished], timeout=min(stallTimeout - idle, deadline - now))
+  finally:
+    transport.close()
+    await protocol.finished
+
+  if protocol.error is not None:
+    return describeError(protocol.error)
+
+  return None if protocol.decoder is not None and protocol.decoder.done else "the server closed the connection"
+
+async def recordStream (job, writerOptions, stallTimeout, metrics):
+  # record one job until its deadline (or the end of its stream), reconnecting as needed; returns whether it
+  # succeeded
+  loop = asyncio.get_running_loop()
+  deadline = loop.time() + job.seconds
+
+  try:
+    writer = DiskWriter(job.filename, metrics=metrics, **writerOptions)
+  except OSError as error:
+    stderr("ERROR: cannot create %s: %s" % (job.filename, error))
+    return False
+
+  reconnector = Reconnector(job.url)
+  metrics.begin(writer, reconnector)
+  writer.start()
+
+  try:
+    while writer.error is None:
+      try:
+        reason = await captureOnce(job, writer, reconnector, metrics, deadline, stallTimeout)
+      except (OSError, ValueError, http.client.HTTPException, asyncio.TimeoutError) as error:
+        reason = describeError(error)
+
+      remaining = deadline - loop.time()
+
+      if reason is None or remaining <= 0:
+        break
+
+      await asyncio.sleep(min(reconnector.lost(reason), remaining))
+  except asyncio.CancelledError:
+    # interrupted (see recordStreams): stop here, keeping and reporting what was recorded
+    pass
+  finally:
+    reconnector.finish()
+
+    # closing waits for the last writes, which mustn't hold up the other streams
+    await loop.run_in_executor(None, writer.close)
+    metrics.end()
+
+  return finishCapture(job.url, writer, reconnector)
+
+async def recordStreams (jobs, writerOptions, stallTimeout, streams):
+  loop = asyncio.get_running_loop()
+  tasks = [
+    asyncio.ensure_future(recordStream(job, writerOptions, stallTimeout, metrics))
+    for job, metrics in zip(jobs, streams)
+  ]
+
+  def interrupt ():
+    # Ctrl-C cancels every capture (once), and each one closes its writer and reports as it would at its deadline
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+
+    for task in tasks:
+      task.cancel()
+
+  try:
+    loop.add_signal_handler(signal.SIGINT, interrupt)
+    interruptible = True
+  except NotImplementedError:
+    # (no signal handlers on this platform's event loop: Ctrl-C just raises KeyboardInterrupt)
+    interruptible = False
+
+  try:
+    results = await asyncio.gather(*tasks)
+  finally:
+    if interruptible:
+      loop.remove_signal_handler(signal.SIGINT)
+
+  return all(results)
+
+def main ():
+  processArgs()
+  jobs = getJobs()
+  writerOptions = getWriterOptions()
+  stallTimeout = getStallTimeout()
+  segment = 0 if writerOptions["segmentSize"] or writerOptions["segmentTime"] else None
+
+  for job in jobs:
+    if os.path.exists(outputFileName(job.filename, segment)):
+      die("the file/folder %s already exists" % outputFileName(job.filename, segment))
+
+  streams = [StreamMetrics(job.url, job.filename) for job in jobs]
+  reporter = getMetricsReporter(streams)
+
+  if reporter is not None:
+    reporter.start()
+
+  try:
+    if len(jobs) == 1 and _value_job_file is None:
+      streamer = StreamThread(jobs[0].url, jobs[0].filename, time.monotonic() + jobs[0].seconds, writerOptions,
+                              stallTimeout, streams[0])
+      # the capture stops itself at its deadline; an interrupt stops it early, keeping what was recorded
+      signal.signal(signal.SIGINT, stopCapturing)
+      streamer.start()
+      streamer.join()
+
+      succeeded = streamer.succeeded
+    else:
+      succeeded = asyncio.run(recordStreams(jobs, writerOptions, stallTimeout, streams))
+  finally:
+    if reporter is not None:
+      reporter.stop()
+
+  if not succeeded:
+    exit(1)
+
+if __name__ == "__main__":
+  main()
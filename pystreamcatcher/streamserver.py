@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+# A local stand-in for a stream server, for testing and benchmarking pystreamcatcher without touching real ones.
+#
+# Every request gets a stream shaped by its query string, so one server covers every scenario:
+#
+#   rate=<bytes/s>        pace the stream (default: 0, as fast as possible)
+#   bytes=<count>         a finite body of <count> bytes, sent with Content-Length, "Accept-Ranges: bytes" and
+#                         Range support (default: 0, an endless live stream)
+#   chunked=1             use chunked transfer encoding (chunks of up to <burst> bytes)
+#   burst=<bytes>         send in bursts of <bytes> (default: 16384); paced streams sleep between bursts
+#   stall_every=<s>       every <s> seconds of streaming, stop sending for <stall> seconds
+#   stall=<s>             how long each stall lasts (default: 5)
+#   drop_after=<bytes>    close the connection after sending <bytes> on it
+#   ranges=0              ignore Range requests on finite bodies
+#
+# Each 8-byte word of the body is its own index as a little-endian integer (bytes 8k to 8k+7 hold k), whichever
+# connection (or Range request) it arrived on, so a capture with any gap or repeat in it, of whatever length, fails
+# checkPattern().
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from functools import lru_cache
+import re
+import sys
+import time
+
+DEFAULT_BURST = 16 * 1024
+DEFAULT_STALL = 5.0
+
+@lru_cache(maxsize=16)
+def getWordSums (words):
+  # the words 0, 1, 2 ... and 1, 1, 1 ... as little-endian integers
+  return sum(index << (64 * index) for index in range(words)), sum(1 << (64 * index) for index in range(words))
+
+def getPattern (offset, count):
+  # count bytes of the body starting at offset; the words first, first + 1 ... are first * ones + indices as one
+  # little-endian integer, which builds a burst many times faster than packing it word by word
+  start = offset % 8
+  words = (start + count + 7) // 8
+  indices, ones = getWordSums(words)
+  return (indices + offset // 8 * ones).to_bytes(8 * words, "little")[start:start + count]
+
+def checkPattern (fileName, offset = 0):
+  """ Returns whether a file holds the body pattern, from offset on, and nothing else """
+  with open(fileName, "rb") as captured:
+    while True:
+      data = captured.read(1024 * 1024)
+
+      if not data:
+        return True
+
+      if data != getPattern(offset, len(data)):
+        return False
+
+      offset += len(data)
+
+
+class StreamHandler (BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message (self, format, *args):
+    pass
+
+  def do_GET (self):
+    query = { name: values[0] for name, values in parse_qs(urlparse(self.path).query).items() }
+
+    try:
+      rate = float(query.get("rate", 0))
+      total = int(query.get("bytes", 0)) or None
+      chunked = query.get("chunked") == "1"
+      burst = int(query.get("burst", DEFAULT_BURST))
+      stallEvery = float(query.get("stall_every", 0))
+      stall = float(query.get("stall", DEFAULT_STALL))
+      dropAfter = int(query.get("drop_after", 0))
+      ranges = total is not None and query.get("ranges") != "0"
+    except ValueError:
+      self.send_error(400, "bad stream parameters")
+      return
+
+    start = 0
+    match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+
+    if ranges and match and int(match.group(1)) < total:
+      start = int(match.group(1))
+      self.send_response(206)
+      self.send_header("Content-Range", "bytes %d-%d/%d" % (start, total - 1, total))
+    else:
+      self.send_response(200)
+
+    self.send_header("Content-Type", "application/octet-stream")
+
+    if ranges:
+      self.send_header("Accept-Ranges", "bytes")
+
+    if chunked:
+      self.send_header("Transfer-Encoding", "chunked")
+    elif total is not None:
+      self.send_header("Content-Length", str(total - start))
+
+    self.send_header("Connection", "close")
+    self.end_headers()
+
+    try:
+      self.sendBody(start, total, rate, burst, chunked, stallEvery, stall, dropAfter)
+    except (BrokenPipeError, ConnectionResetError):
+      pass
+
+  def sendBody (self, offset, total, rate, burst, chunked, stallEvery, stall, dropAfter):
+    started = nextStall = time.monotonic()
+    nextStall += stallEvery
+    sent = 0
+
+    while total is None or offset < total:
+      count = burst if total is None else min(burst, total - offset)
+
+      if dropAfter:
+        count = min(count, dropAfter - sent)
+
+      data = getPattern(offset, count)
+
+      if chunked:
+        self.wfile.write(b"%x\r\n%s\r\n" % (count, data))
+      else:
+        self.wfile.write(data)
+
+      offset += count
+      sent += count
+
+      if dropAfter and sent >= dropAfter:
+        return
+
+      if stallEvery and time.monotonic() >= nextStall:
+        time.sleep(stall)
+        started += stall
+        nextStall = time.monotonic() + stallEvery
+
+      if rate:
+        delay = started + sent / rate - time.monotonic()
+
+        if delay > 0:
+          time.sleep(delay)
+
+    if chunked:
+      self.wfile.write(b"0\r\n\r\n")
+
+
+class StreamServer (ThreadingHTTPServer):
+  # many streams connect at once; the default backlog of 5 would leave most waiting on SYN retransmits
+  request_queue_size = 1024
+  daemon_threads = True
+
+
+def main ():
+  host, port = "127.0.0.1", 8000
+
+  for index, arg in enumerate(sys.argv[1:], 1):
+    if arg in ("-p", "--port") and index + 1 < len(sys.argv):
+      port = int(sys.argv[index + 1])
+    elif arg == "--host" and index + 1 < len(sys.argv):
+      host = sys.argv[index + 1]
+    elif arg in ("-h", "-?", "--help"):
+      print("Usage: %s [--host <address>] [-p|--port <port>]  (port 0 picks a free one)" % sys.argv[0])
+      return
+
+  server = StreamServer((host, port), StreamHandler)
+
+  # the first line out says where to connect (which is how the benchmark learns a port picked with --port 0)
+  print("listening on http://%s:%d/" % server.server_address[:2], flush=True)
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == "__main__":
+  main()
@@ -2,60 +2,1696 @@
 
 import os
 import sys
+import mmap
+import json
+import zlib
+import time
+import struct
+import shutil
+import heapq
+import hashlib
+import subprocess
+import re
+import queue
+import fnmatch
+import sqlite3
+import argparse
 import platform
-import tempfile
-from zipfile import ZipFile
+import threading
+from io import BytesIO
+from functools import partial
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from bisect import bisect_left
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+# optional: an Aho-Corasick automaton keeps matching cost flat however many rules there are
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 if platform.system() == "Windows":
     import win32api, win32con, win32process
     import wmi
 
+# optional: lets the I/O priority be set without running the ionice command
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# number of archives handed to a worker process in one task
+CHUNK_SIZE = 16
+
+# number of tasks allowed to be queued per worker before the walk waits for results
+QUEUE_DEPTH = 4
+
+# number of archives recorded in the scan cache between commits
+CACHE_COMMIT_INTERVAL = 1000
+
+# how far lower_priority() goes: nice increments, and the lowest best-effort I/O priority level
+PRIORITY_NICE = {"low": 10, "idle": 19}
+IONICE_LOWEST_LEVEL = 7
+
+# adaptive throttling: weights of the quick and the slow latency averages, how far the quick one may rise above the
+# slow one before the scan backs off, and the range of the delay it inserts between archives
+LATENCY_FAST_WEIGHT = 0.3
+LATENCY_SLOW_WEIGHT = 0.01
+LATENCY_BACKOFF_RATIO = 2.0
+BACKOFF_MIN_DELAY = 0.001
+BACKOFF_MAX_DELAY = 1.0
+
+# how many of the slowest archives the progress reports name
+SLOWEST_ARCHIVES = 5
+
+# duplicate detection hashes files this much at a time
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# bumped whenever the layout of the scan cache (or the meaning of what it records) changes
+CACHE_SCHEMA_VERSION = 5
+
+# file names which are inspected as archives, on disk and nested inside other archives
+ARCHIVE_EXTENSIONS = (".jar", ".war", ".ear")
+
+# separates an outer archive from the path of an entry inside one of its nested archives
+NESTED_SEPARATOR = "!/"
+
+# how many levels of archives-inside-archives are opened, and how much memory their buffers may use together
+DEFAULT_MAX_DEPTH = 3
+DEFAULT_MEMORY_CAP = 256 * 1024 * 1024
+
+# filesystems which never hold archives worth scanning, skipped even when the walk crosses mount points
+PSEUDO_FILESYSTEMS = {
+    "proc", "sysfs", "devtmpfs", "devpts", "cgroup", "cgroup2", "debugfs", "tracefs", "securityfs", "pstore", "bpf",
+    "configfs", "fusectl", "mqueue", "hugetlbfs", "binfmt_misc", "autofs", "efivarfs", "rpc_pipefs", "nsfs",
+}
+MOUNT_TABLE = "/proc/self/mounts"
+
+# filesystems on other machines, which a default scan leaves to those machines (as Windows scans only local disks)
+NETWORK_FILESYSTEMS = {
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "ncpfs", "afs", "ceph", "glusterfs", "lustre", "9p", "davfs",
+    "fuse.sshfs", "fuse.s3fs", "fuse.rclone",
+}
 
-def lower_priority():
-    pid = win32api.GetCurrentProcessId()
-    handle = win32api.OpenProcess(win32con.PROCESS_ALL_ACCESS, True, pid)
-    win32process.SetPriorityClass(handle, win32process.BELOW_NORMAL_PRIORITY_CLASS)
+# directories handed out to walker threads, and the number of files they pass back at a time
+WALK_BATCH_SIZE = 256
 
+# what is looked for in entry names when no rule file is given
+DEFAULT_RULES = [{"id": "spring-framework", "contains": "springframework"}]
 
-# Generate a list of files by walking recursively down a path
-def walk_tree(path):
-    for root, d_names, f_names in os.walk(path):
-        for f in f_names:
-            yield os.path.join(root, f).lower()
+# how a rule's value is compared with (lowercased) entry names
+RULE_KINDS = ("contains", "prefix", "class", "path", "artifact")
+VERSION_OPERATORS = ("<=", ">=", "==", "!=", "<", ">")
 
+# below this many distinct rule values the regular expression (a plain substring search, for one) beats the automaton
+AUTOMATON_MIN_VALUES = 8
+
+# zip structures read by the central directory fast path (see APPNOTE.TXT)
+EOCD = struct.Struct("<4s4H2LH")
+EOCD_SIGNATURE = b"PK\x05\x06"
+EOCD64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+CENTRAL_HEADER_SIGNATURE = b"PK\x01\x02"
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+MAX_COMMENT = 0xFFFF
+FLAG_UTF8 = 0x800
+
+# where an archive's own version is recorded, and the largest such file worth reading
+MANIFEST = "meta-inf/manifest.mf"
+MANIFEST_VERSION_KEYS = ("implementation-version", "bundle-version")
+POM_PROPERTIES = ("meta-inf/maven/", "/pom.properties")
+MAX_METADATA_SIZE = 1024 * 1024
+
+# outcome of inspecting one archive: the matching [entry name, rule id] pairs, the (exception class, message) which
+# stopped it, the nested archives which weren't inspected (with the reason why), the version of each archive (the one
+# on disk is "", nested ones are named by their path) which had matching entries, and the bytes read and seconds taken
+ScanResult = namedtuple("ScanResult", ["path", "items", "error", "skipped", "versions", "bytes_read", "elapsed"],
+                        defaults=(0, 0.0))
+
+
+# The central directory fast path can't (or won't) handle this archive; ZipFile gets to deal with it
+class UnsupportedArchive(Exception):
+    pass
+
+
+# Make the scan (and the worker processes it starts, which inherit this) yield CPU and disk to everything else
+def lower_priority(level="low"):
+    if level == "normal":
+        return
 
-def main(root_tmpdir):
     if platform.system() == "Windows":
+        pid = win32api.GetCurrentProcessId()
+        handle = win32api.OpenProcess(win32con.PROCESS_ALL_ACCESS, True, pid)
+        priority = win32process.IDLE_PRIORITY_CLASS if level == "idle" else win32process.BELOW_NORMAL_PRIORITY_CLASS
+        win32process.SetPriorityClass(handle, priority)
+        return
+
+    try:
+        os.nice(PRIORITY_NICE[level])
+    except OSError as error:
+        print(f"can't lower CPU priority: {error}", file=sys.stderr)
+
+    if platform.system() != "Linux":
+        return
+
+    # I/O priority: the idle class only gets the disk when nobody else wants it, "low" is the lowest best-effort level
+    try:
+        if psutil is not None:
+            if level == "idle":
+                psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+            else:
+                psutil.Process().ionice(psutil.IOPRIO_CLASS_BE, IONICE_LOWEST_LEVEL)
+        elif shutil.which("ionice"):
+            ionice = ["-c", "3"] if level == "idle" else ["-c", "2", "-n", str(IONICE_LOWEST_LEVEL)]
+            subprocess.run(["ionice"] + ionice + ["-p", str(os.getpid())], check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as error:
+        print(f"can't lower I/O priority: {error}", file=sys.stderr)
+
+
+class TokenBucket:
+    """ Allows rate units per second on average, in bursts of up to a second's worth.  Spending is allowed to run into
+    debt (the cost of an archive is only known once it's been read), which later waits pay back """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def spend(self, amount):
+        self.tokens -= amount
+
+    def wait(self):
+        # sleeps until the bucket isn't in debt; returns the time slept
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 0:
+            return 0.0
+
+        delay = -self.tokens / self.rate
+        time.sleep(delay)
+        return delay
+
+
+class Throttle:
+    """ Paces the scan: a files-per-second and a bytes-per-second budget, and (if adaptive) a delay between archives
+    which grows while inspections take much longer than usual (the disk is busy) and shrinks again once they don't """
+
+    def __init__(self, bytes_per_second=None, files_per_second=None, adaptive=False):
+        self.buckets = {
+            "bytes": TokenBucket(bytes_per_second) if bytes_per_second else None,
+            "files": TokenBucket(files_per_second) if files_per_second else None,
+        }
+        self.adaptive = adaptive
+        self.latency = None
+        self.baseline = None
+        self.delay = 0.0
+        self.slept = 0.0
+
+    def __bool__(self):
+        return self.adaptive or any(self.buckets.values())
+
+    def before(self):
+        # call before reading an archive
+        if self.buckets["files"] is not None:
+            self.buckets["files"].spend(1)
+
+        for bucket in self.buckets.values():
+            if bucket is not None:
+                self.slept += bucket.wait()
+
+        if self.delay:
+            time.sleep(self.delay)
+            self.slept += self.delay
+
+    def after(self, bytes_read, elapsed=None):
+        # call with what reading an archive (or hashing a file) cost
+        if self.buckets["bytes"] is not None:
+            self.buckets["bytes"].spend(bytes_read)
+
+        if not self.adaptive or elapsed is None:
+            return
+
+        # a quick and a slow moving average of the latency: the slow one is what's normal for this disk
+        if self.latency is None:
+            self.latency = self.baseline = elapsed
+
+        self.latency += LATENCY_FAST_WEIGHT * (elapsed - self.latency)
+        self.baseline += LATENCY_SLOW_WEIGHT * (elapsed - self.baseline)
+
+        if self.latency > self.baseline * LATENCY_BACKOFF_RATIO:
+            self.delay = min(max(self.delay * 2, BACKOFF_MIN_DELAY), BACKOFF_MAX_DELAY)
+        else:
+            self.delay = self.delay / 2 if self.delay > BACKOFF_MIN_DELAY else 0.0
+
+
+# Mount points and their filesystem types, from the kernel's mount table (None where there isn't one to read)
+def load_mounts():
+    try:
+        with open(MOUNT_TABLE) as mount_table:
+            lines = mount_table.readlines()
+    except OSError:
+        return None
+
+    mounts = {}
+
+    for line in lines:
+        fields = line.split()
+
+        if len(fields) >= 3:
+            # spaces and the like in mount points are octal-escaped
+            mount_point = fields[1].encode().decode("unicode_escape").encode("latin-1").decode(errors="surrogateescape")
+            mounts[mount_point] = fields[2]
+
+    return mounts
+
+
+# Mount points of every local filesystem worth scanning, for a scan of the whole machine (None where there's no mount
+# table); each is walked on its own, so the walk still never crosses from one filesystem into another
+def local_mount_points(mounts):
+    if mounts is None:
+        return None
+
+    pseudo = [mount_point for mount_point, fs_type in mounts.items() if fs_type in PSEUDO_FILESYSTEMS]
+
+    return sorted(
+        mount_point for mount_point, fs_type in mounts.items()
+        if fs_type not in PSEUDO_FILESYSTEMS and fs_type not in NETWORK_FILESYSTEMS
+        and not any(is_under(mount_point, root) for root in pseudo)
+    )
+
+
+# Compile globs into one matcher (None when there are none)
+def compile_globs(globs):
+    if not globs:
+        return None
+
+    return re.compile("|".join(fnmatch.translate(os.path.normcase(glob)) for glob in globs)).match
+
+
+class TreeWalker:
+    """ Finds files with given extensions under a directory, using os.scandir.  Names are filtered by extension before
+    any path is built for them; other filesystems mounted below the top (and pseudo filesystems like /proc, whatever
+    the settings) are pruned; include/exclude globs are matched against the full path """
+
+    def __init__(self, extensions=ARCHIVE_EXTENSIONS, include=None, exclude=None, cross_mounts=False, threads=1):
+        self.extensions = {extension.lower() for extension in extensions}
+        self.include = compile_globs(include)
+        self.exclude = compile_globs(exclude)
+        self.cross_mounts = cross_mounts
+        self.threads = threads
+        self.mounts = load_mounts()
+        self.normcase = os.path.normcase if os.path.normcase("A") != "A" else None
+
+        # progress, and the (directory, exception) of each directory which couldn't be listed, for whoever's reporting
+        self.entries_walked = 0
+        self.directories_walked = 0
+        self.errors = queue.SimpleQueue()
+
+    def matches(self, matcher, path):
+        return matcher(self.normcase(path) if self.normcase else path)
+
+    def descend(self, entry, device):
+        # should the walk go into this sub-directory?
+        if self.exclude and self.matches(self.exclude, entry.path):
+            return False
+
+        if self.mounts is not None:
+            fs_type = self.mounts.get(entry.path)
+
+            return fs_type is None or (self.cross_mounts and fs_type not in PSEUDO_FILESYSTEMS)
+
+        if self.cross_mounts or device is None:
+            return True
+
+        # no mount table: a different device number means a mount point
+        return entry.stat(follow_symlinks=False).st_dev == device
+
+    def scan_directory(self, directory, device):
+        # returns the matching files, the sub-directories to descend into and the number of entries listed;
+        # unreadable directories are skipped (like os.walk does), but recorded in self.errors
+        files = []
+        directories = []
+        count = 0
+
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    count += 1
+
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.descend(entry, device):
+                                directories.append(entry.path)
+
+                            continue
+                    except OSError:
+                        continue
+
+                    name = entry.name
+                    dot = name.rfind(".")
+
+                    if dot < 0 or name[dot:].lower() not in self.extensions:
+                        continue
+
+                    path = entry.path
+
+                    if self.include and not self.matches(self.include, path):
+                        continue
+
+                    if self.exclude and self.matches(self.exclude, path):
+                        continue
+
+                    files.append(path)
+        except OSError as error:
+            self.errors.put((directory, error))
+
+        return files, directories, count
+
+    def top_device(self, top):
+        # the device the walk stays on, where there's no mount table to tell mount points apart
+        if self.mounts is not None or self.cross_mounts or platform.system() == "Windows":
+            return None
+
+        try:
+            return os.stat(top).st_dev
+        except OSError:
+            return None
+
+    def walk(self, top):
+        if self.threads > 1:
+            return self.walk_threaded(top)
+
+        return self.walk_sequential(top)
+
+    def walk_sequential(self, top):
+        device = self.top_device(top)
+        directories = [top]
+
+        while directories:
+            files, subdirectories, count = self.scan_directory(directories.pop(), device)
+            self.entries_walked += count
+            self.directories_walked += 1
+            yield from files
+            directories.extend(reversed(subdirectories))
+
+    def walk_threaded(self, top):
+        # several threads list directories at once: on network storage each listing is mostly waiting
+        device = self.top_device(top)
+        directories = queue.Queue()
+        results = queue.Queue()
+        lock = threading.Lock()
+        outstanding = [1]
+        stop = threading.Event()
+
+        def walker():
+            while True:
+                directory = directories.get()
+
+                if directory is None or stop.is_set():
+                    return
+
+                files, subdirectories, count = self.scan_directory(directory, device)
+
+                with lock:
+                    outstanding[0] += len(subdirectories)
+                    self.entries_walked += count
+                    self.directories_walked += 1
+
+                for subdirectory in subdirectories:
+                    directories.put(subdirectory)
+
+                for index in range(0, len(files), WALK_BATCH_SIZE):
+                    results.put(files[index:index + WALK_BATCH_SIZE])
+
+                with lock:
+                    outstanding[0] -= 1
+
+                    if outstanding[0] == 0:
+                        results.put(None)
+
+        threads = [threading.Thread(target=walker, daemon=True) for _ in range(self.threads)]
+        directories.put(top)
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                files = results.get()
+
+                if files is None:
+                    break
+
+                yield from files
+        finally:
+            stop.set()
+
+            for _ in threads:
+                directories.put(None)
+
+
+# Generate a list of archives by walking recursively down a path
+def walk_tree(path, walker=None):
+    return (walker or TreeWalker()).walk(path)
+
+
+# Leading numeric components of a version, for comparing them ("5.3.18.RELEASE" -> (5, 3, 18)); None if there are none
+def version_key(version):
+    match = re.match(r"\s*v?(\d+(?:\.\d+)*)", version or "")
+    return tuple(int(part) for part in match.group(1).split(".")) if match else None
+
+
+def parse_version_range(text):
+    # "<op><version>" comparisons joined with commas, all of which must hold, e.g. ">=2.0,<2.15.0"
+    comparisons = []
+
+    for comparison in text.split(","):
+        comparison = comparison.strip()
+        operator = next((operator for operator in VERSION_OPERATORS if comparison.startswith(operator)), "==")
+        key = version_key(comparison[len(operator):] if comparison.startswith(operator) else comparison)
+
+        if key is None:
+            raise ValueError(f"bad version range {text!r}")
+
+        comparisons.append((operator, key))
+
+    return comparisons
+
+
+def compare_versions(key, operator, bound):
+    # versions of different lengths compare as if padded with zeros, so 5.3 == 5.3.0
+    width = max(len(key), len(bound))
+    key, bound = key + (0,) * (width - len(key)), bound + (0,) * (width - len(bound))
+
+    return {"<": key < bound, "<=": key <= bound, ">": key > bound, ">=": key >= bound, "==": key == bound,
+            "!=": key != bound}[operator]
+
+
+class Rule:
+    """ One signature: an id to report it under, what kind of match it is, the (lowercased) value to match, and the
+    version ranges of the containing archive which are affected (an unknown version is always reported) """
+
+    def __init__(self, spec):
+        kinds = [kind for kind in RULE_KINDS if kind in spec]
+
+        if len(kinds) != 1 or not isinstance(spec[kinds[0]], str) or not spec[kinds[0]]:
+            raise ValueError(f"rule {spec!r} needs exactly one of: {', '.join(RULE_KINDS)}")
+
+        self.kind = kinds[0]
+        self.value = spec[self.kind].lower()
+        self.id = str(spec.get("id", f"{self.kind}:{self.value}"))
+
+        versions = spec.get("versions", [])
+        self.ranges = [parse_version_range(text) for text in ([versions] if isinstance(versions, str) else versions)]
+
+    def matches_at(self, name, start):
+        # is this rule's value, found in name at start, a match of this rule's kind?
+        end = start + len(self.value)
+
+        if self.kind == "contains":
+            return True
+        elif self.kind == "prefix":
+            return start == 0
+        elif self.kind == "path":
+            return start == 0 and end == len(name)
+        elif self.kind == "class":
+            return end == len(name) and (start == 0 or name[start - 1] == "/")
+
+        # artifact: a nested archive named after it (optionally with a version), or its maven metadata
+        if start and name[start - 1] != "/":
+            return False
+
+        rest = name[end:]
+
+        if rest.startswith("/pom.properties"):
+            return rest == "/pom.properties" and name.startswith(POM_PROPERTIES[0])
+
+        return rest.endswith(ARCHIVE_EXTENSIONS) and (rest[0] == "-" or rest[0] == ".") and "/" not in rest
+
+    def version_hint(self, name, start):
+        # the version in a nested archive's file name (log4j-core-2.14.1.jar), when that's what matched
+        rest = name[start + len(self.value):]
+
+        if self.kind == "artifact" and rest.startswith("-") and rest.endswith(ARCHIVE_EXTENSIONS):
+            return rest[1:rest.rfind(".")]
+
+        return None
+
+    def affects(self, version):
+        key = version_key(version)
+
+        if not self.ranges or key is None:
+            return True
+
+        return any(all(compare_versions(key, operator, bound) for operator, bound in comparisons)
+                   for comparisons in self.ranges)
+
+
+# Regular expression source matching any of the given strings (or byte strings), built from a trie of them so the
+# matcher follows shared prefixes once instead of trying every signature at every position
+def trie_pattern(needles):
+    trie = {}
+
+    for needle in needles:
+        node = trie
+
+        for element in needle:
+            node = node.setdefault(element, {})
+
+        node[None] = True
+
+    def node_pattern(node):
+        branches = [
+            re.escape(element if isinstance(element, str) else bytes([element]).decode("latin-1")) + node_pattern(child)
+            for element, child in sorted((key, value) for key, value in node.items() if key is not None)
+        ]
+
+        if not branches:
+            return ""
+
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{pattern})?" if None in node else pattern
+
+    return node_pattern(trie)
+
+
+class RuleSet:
+    """ All the rules, matched together: one regular expression over every rule value finds candidate entries (in the
+    raw central directory bytes, or in a name), and only the candidates are checked rule by rule """
+
+    def __init__(self, specs):
+        self.rules = [Rule(spec) for spec in specs]
+        self.by_value = {}
+        self.trie = {}
+
+        for rule in self.rules:
+            self.by_value.setdefault(rule.value, []).append(rule)
+
+        for value in self.by_value:
+            node = self.trie
+
+            for character in value:
+                node = node.setdefault(character, {})
+
+            node[None] = value
+
+        # central directory names are (mostly) UTF-8, which the byte pattern has to match
+        self.pattern = re.compile(trie_pattern(self.by_value))
+        self.byte_pattern = re.compile(trie_pattern([value.encode() for value in self.by_value]).encode("latin-1"))
+        self.automaton = None
+
+        if ahocorasick is not None and len(self.by_value) >= AUTOMATON_MIN_VALUES:
+            # keyed on the UTF-8 bytes (as latin-1 text), so it can run over the raw central directory
+            self.automaton = ahocorasick.Automaton()
+
+            for value in self.by_value:
+                key = value.encode().decode("latin-1")
+                self.automaton.add_word(key, len(key))
+
+            self.automaton.make_automaton()
+        self.digest = json.dumps(specs, sort_keys=True)
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as rule_file:
+            document = json.load(rule_file)
+
+        specs = document.get("rules") if isinstance(document, dict) else document
+
+        if not isinstance(specs, list) or not specs:
+            raise ValueError(f"{path}: expected a list of rules, or an object with one under \"rules\"")
+
+        return cls(specs)
+
+    def hit_starts(self, data):
+        # the offsets in data (lowercased bytes) where some rule value starts, in order
+        if self.automaton is not None:
+            return sorted({end - length + 1 for end, length in self.automaton.iter(data.decode("latin-1"))})
+
+        starts = []
+        hit = self.byte_pattern.search(data)
+
+        while hit is not None:
+            starts.append(hit.start())
+            hit = self.byte_pattern.search(data, hit.start() + 1)
+
+        return starts
+
+    def match(self, name):
+        # [(rule, version hint)] for each rule matching a lowercased entry name
+        matched = {}
+        hit = self.pattern.search(name)
+
+        # the regex finds where some value starts; the trie walk from there finds every value which starts there
+        while hit is not None:
+            start = hit.start()
+            node = self.trie
+
+            for character in name[start:]:
+                node = node.get(character)
+
+                if node is None:
+                    break
+
+                for rule in self.by_value.get(node.get(None), ()):
+                    if rule not in matched and rule.matches_at(name, start):
+                        matched[rule] = rule.version_hint(name, start)
+
+            hit = self.pattern.search(name, start + 1)
+
+        return list(matched.items())
+
+
+# Keep the matches whose rule affects the version of the archive they were found in, as [entry name, rule id] pairs;
+# returns whether any were kept
+def resolve_matches(matches, version, items):
+    found = len(items)
+
+    for item, rule, hint in matches:
+        if rule.affects(hint or version):
+            items.append([item, rule.id])
+
+    return len(items) > found
+
+
+# Open a nested archive without touching the disk: a stored entry is read through a seekable view of the outer
+# archive, a compressed one is inflated into memory if it fits in what's left of the budget.  Returns the archive
+# and the number of bytes buffered for it.
+def open_nested(zipObj, info, memory_budget):
+    if info.compress_type == ZIP_STORED:
+        return ZipFile(zipObj.open(info), 'r'), 0
+
+    if info.file_size > memory_budget:
+        raise MemoryError(f"{info.file_size} bytes needed, {memory_budget} left under the memory cap")
+
+    with zipObj.open(info) as entry:
+        return ZipFile(BytesIO(entry.read()), 'r'), info.file_size
+
+
+# Pull the archive's own version out of a MANIFEST.MF or pom.properties
+def parse_version(name, content):
+    text = content.decode("utf-8", "replace")
+
+    if name == MANIFEST:
+        for line in text.splitlines():
+            key, _, value = line.partition(":")
+
+            if key.strip().lower() in MANIFEST_VERSION_KEYS and value.strip():
+                return value.strip()
+    else:
+        for line in text.splitlines():
+            key, _, value = line.partition("=")
+
+            if key.strip() == "version" and value.strip():
+                return value.strip()
+
+    return None
+
+
+def is_version_file(name):
+    return name == MANIFEST or (name.startswith(POM_PROPERTIES[0]) and name.endswith(POM_PROPERTIES[1]))
+
+
+# The version in an archive's file name (spring-beans-5.3.20.jar), for archives which don't record their own
+def name_version(name):
+    match = re.search(r"-v?(\d+(?:\.\d+)*[^/\\]*)\.[a-z]+$", name.lower())
+    return match.group(1) if match else None
+
+
+# Find the version of an open archive (only called once it's known to have matching entries)
+def zip_version(zipObj):
+    for info in zipObj.infolist():
+        name = info.filename.lower()
+
+        if is_version_file(name) and info.file_size <= MAX_METADATA_SIZE:
+            version = parse_version(name, zipObj.read(info))
+
+            if version:
+                return version
+
+    return None
+
+
+# Collect the entries of an open archive which match a rule, descending into the archives nested inside it
+def inspect_zip(zipObj, rules, prefix, depth, max_depth, memory_budget, items, skipped, versions, file=""):
+    matches = []
+
+    for info in zipObj.infolist():
+        item = info.filename.lower()
+
+        for rule, hint in rules.match(item):
+            matches.append((prefix + item, rule, hint))
+
+        if not item.endswith(ARCHIVE_EXTENSIONS) or info.is_dir():
+            continue
+
+        nested = prefix + item
+
+        if depth >= max_depth:
+            skipped.append(f"{nested}: nested deeper than {max_depth}")
+            continue
+
+        try:
+            inner, buffered = open_nested(zipObj, info, memory_budget)
+
+            with inner:
+                inspect_zip(inner, rules, nested + NESTED_SEPARATOR, depth + 1, max_depth, memory_budget - buffered,
+                            items, skipped, versions)
+        except Exception as error:
+            # a broken inner archive doesn't spoil what was found in the rest of the outer one
+            skipped.append(f"{nested}: {type(error).__name__}: {error}")
+
+    if matches:
+        version = zip_version(zipObj) or name_version(prefix[:-len(NESTED_SEPARATOR)] or file)
+
+        if resolve_matches(matches, version, items):
+            versions[prefix[:-len(NESTED_SEPARATOR)]] = version
+
+
+# Where the central directory of the zip archive in buf[start:end] is: (end of central directory record, number of
+# entries, offset everything else is relative to, central directory size); raises UnsupportedArchive
+def locate_central_directory(buf, start, end):
+    eocd = buf.rfind(EOCD_SIGNATURE, max(start, end - EOCD.size - MAX_COMMENT), end)
+
+    if eocd < 0 or end - eocd < EOCD.size:
+        raise UnsupportedArchive("no end of central directory record")
+
+    _, disk, cd_disk, disk_entries, entries, cd_size, cd_offset, comment_size = EOCD.unpack_from(buf, eocd)
+
+    if (disk or cd_disk or disk_entries != entries or 0xFFFF in (entries, disk_entries)
+            or 0xFFFFFFFF in (cd_size, cd_offset)
+            or (eocd - 20 >= start and buf[eocd - 20:eocd - 16] == EOCD64_LOCATOR_SIGNATURE)):
+        raise UnsupportedArchive("zip64 or multi-disk archive")
+
+    # anything prepended to the archive (e.g. the launch script of an executable jar) shifts every offset
+    base = eocd - cd_size - cd_offset
+
+    if base < start:
+        raise UnsupportedArchive("central directory outside the archive")
+
+    return eocd, entries, base, cd_size
+
+
+# A zip archive held in buf[start:end] (a memory-mapped file, or an inflated nested archive), read straight from its
+# central directory: entry names are matched in the raw directory bytes, without building a ZipInfo for each entry
+class CentralDirectory:
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+
+        eocd, self.entries, self.base, cd_size = locate_central_directory(buf, start, end)
+        self.cd_start = eocd - cd_size
+        self.cd_end = eocd
+
+        # bytes.lower() only folds ASCII, which is all the signature and the extensions need
+        self.lowered = bytes(buf[self.cd_start:self.cd_end]).lower()
+        self.bytes_read = end - eocd + cd_size
+
+        # when the header signature occurs exactly once per entry, every occurrence is a real header, so a match can
+        # be traced back to its entry by searching backwards; otherwise the entries have to be walked one by one
+        self.headers_unambiguous = self.lowered.count(CENTRAL_HEADER_SIGNATURE.lower()) == self.entries
+
+    def __iter__(self):
+        # (name start, name end, central header offset) of each entry, relative to self.lowered
+        offset = 0
+
+        for _ in range(self.entries):
+            if self.lowered[offset:offset + 4] != CENTRAL_HEADER_SIGNATURE.lower():
+                raise UnsupportedArchive("corrupt central directory")
+
+            name_length, extra_length, comment_length = struct.unpack_from("<3H", self.lowered, offset + 28)
+            yield offset + CENTRAL_HEADER.size, offset + CENTRAL_HEADER.size + name_length, offset
+            offset += CENTRAL_HEADER.size + name_length + extra_length + comment_length
+
+    def search(self, rules):
+        # central header offsets of the entries whose (lowercased) name has a rule value starting in it
+        lowered = self.lowered
+        starts = rules.hit_starts(lowered)
+
+        if not starts:
+            return []
+
+        if not self.headers_unambiguous:
+            return [
+                header for name_start, name_end, header in self
+                if bisect_left(starts, name_start) < len(starts) and starts[bisect_left(starts, name_start)] < name_end
+            ]
+
+        headers = []
+        signature = CENTRAL_HEADER_SIGNATURE.lower()
+        matched_end = 0
+
+        for start in starts:
+            # (further hits in a name already known to match)
+            if start < matched_end:
+                continue
+
+            header = lowered.rfind(signature, 0, start - CENTRAL_HEADER.size + len(signature))
+
+            if header < 0:
+                raise UnsupportedArchive("corrupt central directory")
+
+            name_end = header + CENTRAL_HEADER.size + struct.unpack_from("<H", lowered, header + 28)[0]
+
+            # (a hit beyond the name is in the entry's extra field or comment)
+            if start < name_end:
+                headers.append(header)
+                matched_end = name_end
+
+        return headers
+
+    def find(self, needle, suffix=False):
+        # central header offsets of the entries whose (lowercased) name contains, or ends with, needle
+        lowered = self.lowered
+
+        if lowered.find(needle) < 0:
+            return []
+
+        if not self.headers_unambiguous:
+            return [
+                header for name_start, name_end, header in self
+                if (lowered.endswith(needle, name_start, name_end) if suffix
+                    else lowered.find(needle, name_start, name_end) >= 0)
+            ]
+
+        headers = []
+        signature = CENTRAL_HEADER_SIGNATURE.lower()
+        hit = lowered.find(needle)
+
+        while hit >= 0:
+            header = lowered.rfind(signature, 0, hit - CENTRAL_HEADER.size + len(signature))
+
+            if header < 0:
+                raise UnsupportedArchive("corrupt central directory")
+
+            name_end = header + CENTRAL_HEADER.size + struct.unpack_from("<H", lowered, header + 28)[0]
+            matches = hit + len(needle) == name_end if suffix else hit + len(needle) <= name_end
+
+            # (a hit beyond the name is in the entry's extra field or comment)
+            if matches:
+                headers.append(header)
+
+            hit = lowered.find(needle, max(hit + 1, name_end) if matches else hit + 1)
+
+        return headers
+
+    def name(self, header):
+        # the entry name as ZipFile would report it (decoded, then lowercased)
+        fields = CENTRAL_HEADER.unpack_from(self.buf, self.cd_start + header)
+        raw = bytes(self.buf[self.cd_start + header + CENTRAL_HEADER.size:
+                             self.cd_start + header + CENTRAL_HEADER.size + fields[10]])
+        return raw.decode("utf-8" if fields[3] & FLAG_UTF8 else "cp437").lower()
+
+    def data(self, header):
+        # (method, start, compressed size, uncompressed size) of an entry's data in buf
+        fields = CENTRAL_HEADER.unpack_from(self.buf, self.cd_start + header)
+        method, compressed_size, file_size, local_offset = fields[4], fields[8], fields[9], fields[16]
+        local = self.base + local_offset
+        local_fields = LOCAL_HEADER.unpack_from(self.buf, local)
+
+        if local_fields[0] != LOCAL_HEADER_SIGNATURE or fields[3] & 0x1:
+            raise UnsupportedArchive("corrupt or encrypted entry")
+
+        return method, local + LOCAL_HEADER.size + local_fields[9] + local_fields[10], compressed_size, file_size
+
+    def read(self, header, limit):
+        method, start, compressed_size, file_size = self.data(header)
+
+        if file_size > limit:
+            raise MemoryError(f"{file_size} bytes needed, {limit} left under the memory cap")
+
+        self.bytes_read += compressed_size
+
+        if method == ZIP_STORED:
+            return bytes(self.buf[start:start + file_size])
+        elif method == ZIP_DEFLATED:
+            return zlib.decompress(bytes(self.buf[start:start + compressed_size]), -15, max(file_size, 1))
+
+        raise UnsupportedArchive(f"compression method {method}")
+
+    def version(self):
+        # MANIFEST.MF / pom.properties are only looked for (and inflated) once the archive is known to match
+        headers = self.find(MANIFEST.encode(), suffix=True) + self.find(POM_PROPERTIES[1].encode(), suffix=True)
+
+        for header in headers:
+            name = self.name(header)
+
+            if is_version_file(name):
+                version = parse_version(name, self.read(header, MAX_METADATA_SIZE))
+
+                if version:
+                    return version
+
+        return None
+
+
+# The fast path equivalent of inspect_zip; returns the number of bytes of buf it read
+def inspect_central_directory(buf, start, end, rules, prefix, depth, max_depth, memory_budget, items, skipped,
+                              versions, file=""):
+    directory = CentralDirectory(buf, start, end)
+    nested_bytes = 0
+
+    # the common case is nothing to report and nothing nested, known from a single pass of the rule pattern (however
+    # many rules there are) without looking at any entry; otherwise only the entries with a hit are looked at
+    candidates = set(directory.search(rules))
+    archives = set()
+    matches = []
+
+    for extension in ARCHIVE_EXTENSIONS:
+        archives.update(directory.find(extension.encode(), suffix=True))
+
+    for header in sorted(candidates | archives):
+        if header in candidates:
+            item = prefix + directory.name(header)
+
+            for rule, hint in rules.match(item[len(prefix):]):
+                matches.append((item, rule, hint))
+
+        if header not in archives:
+            continue
+
+        nested = prefix + directory.name(header)
+
+        if depth >= max_depth:
+            skipped.append(f"{nested}: nested deeper than {max_depth}")
+            continue
+
+        try:
+            method, data_start, compressed_size, file_size = directory.data(header)
+
+            if method == ZIP_STORED:
+                # a stored archive is scanned in place, inside the outer archive's buffer
+                inner, inner_start, inner_end, buffered = buf, data_start, data_start + file_size, 0
+            else:
+                inner = directory.read(header, memory_budget)
+                inner_start, inner_end, buffered = 0, len(inner), len(inner)
+
+            found, missed = len(items), len(skipped)
+
+            try:
+                inner_bytes = inspect_central_directory(inner, inner_start, inner_end, rules, nested + NESTED_SEPARATOR,
+                                                        depth + 1, max_depth, memory_budget - buffered, items, skipped,
+                                                        versions)
+
+                # (an inflated archive was read from buf by directory.read already)
+                if inner is buf:
+                    nested_bytes += inner_bytes
+            except UnsupportedArchive:
+                # an odd inner archive gets the ZipFile treatment on its own, without giving up on the outer one
+                del items[found:], skipped[missed:]
+
+                if inner_end - inner_start > memory_budget - buffered:
+                    raise MemoryError(f"{inner_end - inner_start} bytes needed, {memory_budget - buffered} left under "
+                                      "the memory cap")
+
+                if inner is buf:
+                    nested_bytes += inner_end - inner_start
+
+                with ZipFile(BytesIO(inner[inner_start:inner_end]), 'r') as zipObj:
+                    inspect_zip(zipObj, rules, nested + NESTED_SEPARATOR, depth + 1, max_depth,
+                                memory_budget - buffered - (inner_end - inner_start), items, skipped, versions)
+        except Exception as error:
+            skipped.append(f"{nested}: {type(error).__name__}: {error}")
+
+    if matches:
+        version = directory.version() or name_version(prefix[:-len(NESTED_SEPARATOR)] or file)
+
+        if resolve_matches(matches, version, items):
+            versions[prefix[:-len(NESTED_SEPARATOR)]] = version
+
+    return directory.bytes_read + nested_bytes
+
+
+# Look inside one archive (and up to max_depth levels of archives nested in it) for entries matching the rules
+def inspect_archive(file, max_depth=DEFAULT_MAX_DEPTH, memory_cap=DEFAULT_MEMORY_CAP, rules=None):
+    if rules is None:
+        rules = RuleSet(DEFAULT_RULES)
+
+    items = []
+    skipped = []
+    versions = {}
+    started = time.perf_counter()
+
+    # fast path: match names in the memory-mapped central directory
+    try:
+        with open(file, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            bytes_read = inspect_central_directory(buf, 0, len(buf), rules, "", 0, max_depth, memory_cap, items,
+                                                   skipped, versions, file)
+
+        return ScanResult(file, items, None, skipped, versions, bytes_read, time.perf_counter() - started)
+    except Exception:
+        # zip64, corrupt, empty or otherwise odd: start over with ZipFile, which also reports the error properly
+        items, skipped, versions = [], [], {}
+
+    # (ZipFile's reads aren't counted: assume the whole archive)
+    try:
+        bytes_read = os.path.getsize(file)
+    except OSError:
+        bytes_read = 0
+
+    try:
+        with ZipFile(file, 'r') as zipObj:
+            inspect_zip(zipObj, rules, "", 0, max_depth, memory_cap, items, skipped, versions, file)
+    except Exception as error:
+        return ScanResult(file, items, (type(error).__name__, str(error)), skipped, versions, bytes_read,
+                          time.perf_counter() - started)
+
+    return ScanResult(file, items, None, skipped, versions, bytes_read, time.perf_counter() - started)
+
+
+# Identify a file by inode, size and modification time (None if it can't be stat'd)
+def file_identity(file):
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+# Is path the same as, or underneath, root?
+def is_under(path, root):
+    return path == root or path.startswith(root.rstrip("/\\") + os.sep)
+
+
+class ScanCache:
+    """ SQLite index of each archive's findings, keyed on path and file identity, so unchanged archives aren't
+    re-opened """
+
+    def __init__(self, path, settings):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        # findings recorded by another version, or with other inspection settings, can't be reused
+        settings = json.dumps({"schema": CACHE_SCHEMA_VERSION, **settings}, sort_keys=True)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+
+        if row is None or row[0] != settings:
+            self.db.execute("DROP TABLE IF EXISTS archives")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('settings', ?)", (settings,))
+
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS archives ("
+            "path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime_ns INTEGER, items TEXT, error TEXT, "
+            "skipped TEXT, versions TEXT, run INTEGER)"
+        )
+        self.db.commit()
+
+        # every archive seen by this run is stamped with its number, so anything left unstamped has been deleted
+        self.run = self.db.execute("SELECT COALESCE(MAX(run), 0) + 1 FROM archives").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.pending_writes = 0
+
+    def lookup(self, file, identity):
+        row = self.db.execute(
+            "SELECT inode, size, mtime_ns, items, error, skipped, versions FROM archives WHERE path = ?", (file,)
+        ).fetchone()
+
+        if row is None or tuple(row[:3]) != identity:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__write("UPDATE archives SET run = ? WHERE path = ?", (self.run, file))
+        return ScanResult(file, json.loads(row[3]), tuple(json.loads(row[4])) if row[4] else None, json.loads(row[5]),
+                          json.loads(row[6]))
+
+    def store(self, result, identity):
+        self.__write(
+            "INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (result.path,) + identity + (
+                json.dumps(result.items), json.dumps(result.error) if result.error else None,
+                json.dumps(result.skipped), json.dumps(result.versions), self.run
+            )
+        )
+
+    def pop_deleted(self, roots):
+        # archives under any of the roots which were cached by an earlier run but not seen by this one no longer exist
+        # (only asked once every root has been walked, as one root may be mounted inside another)
+        deleted = [
+            path for (path,) in self.db.execute("SELECT path FROM archives WHERE run != ?", (self.run,))
+            if any(is_under(path, root) for root in roots)
+        ]
+
+        self.db.executemany("DELETE FROM archives WHERE path = ?", [(path,) for path in deleted])
+        self.db.commit()
+        return deleted
+
+    def __write(self, statement, parameters):
+        # commit in batches, so an interrupted scan still keeps most of its work
+        self.db.execute(statement, parameters)
+        self.pending_writes += 1
+
+        if self.pending_writes >= CACHE_COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class DedupIndex:
+    """ Recognises archives with the same content as one already inspected, by hashing them incrementally: an archive
+    whose size hasn't been seen before is never read; once a size repeats, archives of that size are hashed by their
+    central directory first (the names, sizes and CRC-32s of every entry, which tells nearly all different archives
+    apart cheaply), and only archives whose central directories match too are hashed whole.  Only identical full
+    digests make a copy, so an archive can't pass for another by copying its central directory """
+
+    def __init__(self):
+        self.unhashed = {}         # size -> the one archive of that size seen so far
+        self.hashed_sizes = set()
+        self.directories = {}      # (size, directory digest) -> archive whose full digest hasn't been needed yet, or None
+        self.contents = {}         # full digest -> the archive inspected for that content
+        self.archives = 0
+        self.duplicates = 0
+        self.bytes_hashed = 0
+        self.bytes_deduplicated = 0
+
+    def digest(self, file, whole=True):
+        # the whole file, or its central directory and what follows it (all of it if the fast path can't find one)
+        hasher = hashlib.blake2b(digest_size=16)
+
+        with open(file, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            start = 0
+
+            if not whole:
+                try:
+                    eocd, _, _, cd_size = locate_central_directory(buf, 0, len(buf))
+                    start = eocd - cd_size
+                except UnsupportedArchive:
+                    pass
+
+            for offset in range(start, len(buf), HASH_BLOCK_SIZE):
+                block = buf[offset:offset + HASH_BLOCK_SIZE]
+                hasher.update(block)
+                self.bytes_hashed += len(block)
+
+        return hasher.digest()
+
+    def add(self, file, size):
+        # returns the archive this one is a copy of, or None if it needs inspecting itself
+        self.archives += 1
+
+        if size not in self.hashed_sizes:
+            if size not in self.unhashed:
+                self.unhashed[size] = file
+                return None
+
+            # a second archive of this size: from now on they're all hashed, starting with the first one
+            self.hashed_sizes.add(size)
+            self.__add_hashed(self.unhashed.pop(size), size)
+
+        original = self.__add_hashed(file, size)
+
+        if original is not None:
+            self.duplicates += 1
+            self.bytes_deduplicated += size
+
+        return original
+
+    def __add_hashed(self, file, size):
+        try:
+            key = (size, self.digest(file, whole=False))
+
+            if key not in self.directories:
+                self.directories[key] = file
+                return None
+
+            # the central directories match: now the full contents are needed (once) for the archive already holding it
+            earlier = self.directories[key]
+
+            if earlier is not None:
+                self.directories[key] = None
+                self.contents.setdefault(self.digest(earlier), earlier)
+
+            full = self.digest(file)
+        except (OSError, ValueError):
+            # unreadable (or empty, which can't be mapped): let the inspection report it
+            return None
+
+        # the archive first seen with this content (None when that's this one)
+        original = self.contents.setdefault(full, file)
+        return original if original != file else None
+
+    def stats(self):
+        return {"archives": self.archives, "distinct": self.archives - self.duplicates, "duplicates": self.duplicates,
+                "bytes_deduplicated": self.bytes_deduplicated, "never_hashed": len(self.unhashed),
+                "bytes_hashed": self.bytes_hashed}
+
+    def summary(self):
+        return (f"dedup: {self.archives} archives, {self.archives - self.duplicates} distinct, "
+                f"{self.duplicates} duplicates not re-inspected ({self.bytes_deduplicated / 1048576:.1f} MiB), "
+                f"{len(self.unhashed)} of unique size never hashed, {self.bytes_hashed / 1048576:.1f} MiB hashed")
+
+
+class ScanStats:
+    """ Throughput of a scan: what the walk listed, what was inspected, and which archives took longest """
+
+    def __init__(self, walker):
+        self.walker = walker
+        self.started = time.monotonic()
+        self.archives_opened = 0
+        self.bytes_read = 0
+        self.findings = 0
+        self.errors = 0
+        self.walk_errors = 0
+        self.slowest = []
+
+    def record(self, result):
+        # an archive which was actually inspected (not a cache hit or a copy)
+        self.archives_opened += 1
+        self.bytes_read += result.bytes_read
+
+        if len(self.slowest) < SLOWEST_ARCHIVES:
+            heapq.heappush(self.slowest, (result.elapsed, result.path))
+        elif result.elapsed > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (result.elapsed, result.path))
+
+    def snapshot(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+
+        return {
+            "elapsed": round(elapsed, 3),
+            "files_walked": self.walker.entries_walked,
+            "files_per_second": round(self.walker.entries_walked / elapsed, 1),
+            "directories_walked": self.walker.directories_walked,
+            "archives_opened": self.archives_opened,
+            "archives_per_second": round(self.archives_opened / elapsed, 1),
+            "bytes_read": self.bytes_read,
+            "findings": self.findings,
+            "errors": self.errors,
+            "walk_errors": self.walk_errors,
+            "slowest": [
+                {"path": path, "seconds": round(seconds, 3)} for seconds, path in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+
+class Reporter:
+    """ Writes a scan's results, either as text (findings as path::entry lines) or as JSON lines (one record per
+    finding, failed archive and so on), plus progress reports on stderr every interval seconds (if given) """
+
+    def __init__(self, json_lines=False, show_rules=False, stats=None, interval=None):
+        self.json_lines = json_lines
+        self.show_rules = show_rules
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.progress_thread = None
+
+        if interval:
+            self.progress_thread = threading.Thread(target=self.__progress, args=(interval,), daemon=True)
+            self.progress_thread.start()
+
+    def emit(self, record, text=None, stream=None):
+        # JSON records go to stdout unless told otherwise; text goes wherever it's told (None: nowhere)
+        if self.json_lines:
+            line = json.dumps(record)
+            stream = stream if record["type"] == "progress" else sys.stdout
+        elif text is None:
+            return
+        else:
+            line = text
+
+        with self.lock:
+            print(line, file=stream or sys.stdout, flush=stream is sys.stderr)
+
+    def scanning(self, root):
+        self.emit({"type": "scan", "root": root}, f"scanning {root}")
+
+    def listed(self, path):
+        # an archive listed without being opened
+        self.emit({"type": "archive", "path": path}, path)
+
+    def result(self, result):
+        for item, rule in result.items:
+            archive = item.rpartition(NESTED_SEPARATOR)[0]
+            record = {"type": "finding", "path": result.path, "entry": item, "rule": rule,
+                      "version": result.versions.get(archive)}
+
+            # which rule matched is only worth saying when there's more than one
+            self.emit(record, f"{result.path}::{item}" + (f" [{rule}]" if self.show_rules else ""))
+
+        if self.stats is not None:
+            self.stats.findings += len(result.items)
+
+        if not self.json_lines:
+            for archive, version in result.versions.items():
+                if version:
+                    self.emit(None, f"{result.path}{'::' + archive if archive else ''} version {version}")
+
+        for reason in result.skipped:
+            entry, _, why = reason.partition(": ")
+            self.emit({"type": "skipped", "path": result.path, "entry": entry, "reason": why},
+                      f"{result.path}::{reason} (not inspected)", sys.stderr)
+
+        if result.error:
+            if self.stats is not None:
+                self.stats.errors += 1
+
+            self.emit({"type": "error", "path": result.path, "error": result.error[0], "message": result.error[1]},
+                      f"{result.path}: {result.error[0]}: {result.error[1]} (not inspected)", sys.stderr)
+
+    def deleted(self, path):
+        self.emit({"type": "deleted", "path": path}, f"deleted: {path}")
+
+    def walk_error(self, directory, error):
+        # (text output has always stayed quiet about unreadable directories)
+        if self.stats is not None:
+            self.stats.walk_errors += 1
+
+        self.emit({"type": "walk_error", "path": directory, "error": type(error).__name__, "message": str(error)})
+
+    def progress(self):
+        stats = self.stats.snapshot()
+        slowest = ", ".join(f"{entry['path']} {entry['seconds']:.2f}s" for entry in stats["slowest"])
+
+        self.emit(
+            dict(type="progress", **stats),
+            f"progress: {stats['elapsed']:.0f}s, {stats['files_walked']} files walked "
+            f"({stats['files_per_second']:.0f}/s), {stats['archives_opened']} archives opened "
+            f"({stats['archives_per_second']:.1f}/s), {stats['bytes_read'] / 1048576:.1f} MiB read"
+            + (f"; slowest: {slowest}" if slowest else ""),
+            sys.stderr
+        )
+
+    def __progress(self, interval):
+        while not self.done.wait(interval):
+            self.progress()
+
+    def summary(self, extra, lines):
+        # the final word: extra holds the summaries of the cache, dedup etc. (lines is their text form)
+        self.done.set()
+
+        if self.json_lines:
+            record = {"type": "summary", **(self.stats.snapshot() if self.stats else {}), **extra}
+            self.emit(record)
+            return
+
+        for line in lines:
+            self.emit(None, line, sys.stderr)
+
+
+# What a worker process inspects archives with, set once as it starts: the rules would otherwise be pickled into every
+# chunk of work, and their patterns rebuilt for each one
+worker_settings = {}
+
+
+# Worker process initializer
+def init_worker(max_depth=DEFAULT_MAX_DEPTH, memory_cap=DEFAULT_MEMORY_CAP, rules=None):
+    worker_settings.update(max_depth=max_depth, memory_cap=memory_cap, rules=rules)
+
+
+# Worker process entry point: inspect a chunk of archives
+def inspect_archives(files):
+    return [inspect_archive(file, **worker_settings) for file in files]
+
+
+# Group an iterable into lists of up to size items
+def chunked(iterable, size):
+    chunk = []
+
+    for item in iterable:
+        chunk.append(item)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+# Inspect archives one after another in this process
+def scan_sequential(files, inspect=inspect_archive):
+    for file in files:
+        yield inspect(file)
+
+
+# Inspect archives in a pool of worker processes, yielding results as they complete
+def scan_parallel(files, workers, max_depth=DEFAULT_MAX_DEPTH, memory_cap=DEFAULT_MEMORY_CAP, rules=None):
+    files = iter(files)
+    pending = {}
+    unsubmitted = []
+
+    def collect(return_when):
+        done, _ = wait(pending, return_when=return_when)
+
+        for future in done:
+            results = future.result()
+            del pending[future]
+            yield from results
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(max_depth, memory_cap, rules)) as executor:
+            for chunk in chunked(files, CHUNK_SIZE):
+                unsubmitted = chunk
+                pending[executor.submit(inspect_archives, chunk)] = chunk
+                unsubmitted = []
+
+                # keep the walk from racing ahead of the workers (and queueing every path on the disk in memory)
+                if len(pending) >= workers * QUEUE_DEPTH:
+                    yield from collect(FIRST_COMPLETED)
+
+            while pending:
+                yield from collect(FIRST_COMPLETED)
+    except (BrokenProcessPool, OSError, NotImplementedError) as error:
+        # no usable process pool (or a worker died): finish whatever is left in this process
+        print(f"worker pool unavailable ({error!r}); continuing sequentially", file=sys.stderr)
+
+        inspect = partial(inspect_archive, max_depth=max_depth, memory_cap=memory_cap, rules=rules)
+
+        for chunk in [unsubmitted] + list(pending.values()):
+            yield from scan_sequential(chunk, inspect)
+
+        yield from scan_sequential(files, inspect)
+
+
+def scan_archives(files, workers=1, max_depth=DEFAULT_MAX_DEPTH, memory_cap=DEFAULT_MEMORY_CAP, rules=None):
+    if rules is None:
+        rules = RuleSet(DEFAULT_RULES)
+
+    if workers == 1:
+        return scan_sequential(files, partial(inspect_archive, max_depth=max_depth, memory_cap=memory_cap, rules=rules))
+
+    return scan_parallel(files, workers, max_depth, memory_cap, rules)
+
+
+# "10M" -> 10485760 (K, M, G: binary multiples)
+def parse_size(text):
+    multiplier = 1024 ** ("KMG".index(text[-1].upper()) + 1) if text and text[-1].upper() in "KMG" else 1
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Find Java archives (.jar/.war/.ear) which contain the Spring Framework, or whatever else a rule "
+                    "file describes"
+    )
+    parser.add_argument("paths", nargs="*", help="directories to scan (default: every local drive)")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="worker processes inspecting archives "
+                             "(default: 1, i.e. scan sequentially; 0: one per CPU)")
+    parser.add_argument("--debug", action="store_true", help="only list archives, without opening them")
+    parser.add_argument("--rules", metavar="FILE",
+                        help="JSON file of signatures to look for, each with an id, one of "
+                             f"{'/'.join(RULE_KINDS)} and optionally affected version ranges "
+                             "(default: entries containing 'springframework')")
+    parser.add_argument("--include", action="append", metavar="GLOB",
+                        help="only inspect archives whose full path matches (may be repeated)")
+    parser.add_argument("--exclude", action="append", metavar="GLOB",
+                        help="skip archives and directories whose full path matches, e.g. '*/.git' (may be repeated)")
+    parser.add_argument("--cross-mounts", action="store_true",
+                        help="descend into other filesystems mounted below the scanned paths (pseudo filesystems such "
+                             "as /proc and /sys are skipped regardless)")
+    parser.add_argument("--walkers", type=int, default=1, metavar="N",
+                        help="threads listing directories (default: 1); more help on high-latency network storage")
+    parser.add_argument("--max-depth", type=int, default=DEFAULT_MAX_DEPTH, metavar="N",
+                        help="levels of nested archives (e.g. BOOT-INF/lib/*.jar) to open "
+                             f"(default: {DEFAULT_MAX_DEPTH}; 0: only the archives on disk)")
+    parser.add_argument("--memory-cap", type=int, default=DEFAULT_MEMORY_CAP // (1024 * 1024), metavar="MIB",
+                        help="memory which compressed nested archives may be inflated into, per archive on disk "
+                             f"(default: {DEFAULT_MEMORY_CAP // (1024 * 1024)})")
+    parser.add_argument("--json", action="store_true",
+                        help="write JSON lines: a record per finding, failed archive, skipped nested archive, "
+                             "unreadable directory and deleted archive, then a summary")
+    parser.add_argument("--progress", type=float, metavar="SECONDS",
+                        help="report progress (files walked and archives opened per second, bytes read, the slowest "
+                             "archives) on stderr this often")
+    parser.add_argument("--priority", choices=["normal", "low", "idle"], default="low",
+                        help="CPU and I/O priority to scan at (default: low; idle only gets what nothing else wants)")
+    parser.add_argument("--max-bytes", type=parse_size, metavar="RATE",
+                        help="bytes read per second, e.g. 20M (default: unlimited)")
+    parser.add_argument("--max-files", type=float, metavar="RATE",
+                        help="archives read per second (default: unlimited)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="back off while archives take much longer to read than usual (i.e. the disk is busy)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="inspect each distinct archive once, reporting its findings for every copy; copies are "
+                             "recognised by hashing them whole, which only pays off for archives with much to "
+                             "inspect (e.g. fat jars) copied many times")
+    parser.add_argument("--no-dedup", dest="dedup", action="store_false", help=argparse.SUPPRESS)
+    parser.add_argument("--cache", metavar="FILE",
+                        help="SQLite file remembering each archive's findings; only new or changed archives are "
+                             "opened, and archives which disappeared since the last run are reported")
+    args = parser.parse_args(argv)
+
+    # "debug" used to be given as a bare word
+    if "debug" in args.paths:
+        args.paths.remove("debug")
+        args.debug = True
+
+    if args.workers < 1:
+        args.workers = os.cpu_count() or 1
+
+    args.walkers = max(args.walkers, 1)
+
+    args.memory_cap *= 1024 * 1024
+
+    try:
+        args.rule_set = RuleSet.load(args.rules) if args.rules else RuleSet(DEFAULT_RULES)
+    except (OSError, ValueError) as error:
+        parser.error(f"can't load rules: {error}")
+
+    return args
+
+
+def main(args):
+    if args.paths:
+        # absolute, so they line up with the mount table and with what the scan cache recorded
+        drives = [os.path.abspath(path) for path in args.paths]
+    elif platform.system() == "Windows":
         c = wmi.WMI()
         drives = [f"{drive.Caption}\\" for drive in c.Win32_LogicalDisk(DriveType=3)]
     else:
-        drives = ["/"]
+        # every local filesystem, not just the one mounted on / (unless the walk crosses mounts from / anyway)
+        drives = (not args.cross_mounts and local_mount_points(load_mounts())) or ["/"]
+
+    settings = {"max_depth": args.max_depth, "memory_cap": args.memory_cap, "rules": args.rule_set.digest}
+    cache = ScanCache(args.cache, settings) if args.cache and not args.debug else None
+    dedup = DedupIndex() if args.dedup and not args.debug else None
+    throttle = Throttle(args.max_bytes, args.max_files, args.adaptive)
+    identities = {}
+
+    # for archives with copies: the inspected original's result once it's known, else the copies waiting for it
+    results = {}
+    copies = {}
+    walker = TreeWalker(include=args.include, exclude=args.exclude, cross_mounts=args.cross_mounts,
+                        threads=args.walkers)
+    stats = ScanStats(walker)
+    reporter = Reporter(args.json, len(args.rule_set) > 1, stats, args.progress)
+    report = reporter.result
+
+    def drain_walk_errors():
+        while not walker.errors.empty():
+            reporter.walk_error(*walker.errors.get())
+
+    def finish(result):
+        report(result)
+
+        if cache is not None and identities.get(result.path):
+            cache.store(result, identities.pop(result.path))
 
     for drive in drives:
-        print(f"scanning {drive}")
-        for file in walk_tree(drive):
-            if file.endswith(".jar") or file.endswith(".war"):
-                if "spring" in file or "debug" in sys.argv:
-                    print(file)
+        reporter.scanning(drive)
+
+        # the walk produces candidate archives, the workers open them (unless the cache already knows the answer)
+        def candidates():
+            for file in walk_tree(drive, walker):
+                drain_walk_errors()
+
+                # (without a rule file, archives named after spring are listed as they are, not opened)
+                if (not args.rules and "spring" in file.lower()) or args.debug:
+                    reporter.listed(file)
                     continue
+
+                identity = file_identity(file) if cache is not None or dedup is not None else None
+
+                if cache is not None:
+                    cached = cache.lookup(file, identity) if identity else None
+
+                    if cached is not None:
+                        report(cached)
+                        continue
+
+                    identities[file] = identity
+
+                if throttle:
+                    throttle.before()
+
+                if dedup is not None and identity:
+                    hashed = dedup.bytes_hashed
+                    original = dedup.add(file, identity[1])
+
+                    if throttle:
+                        throttle.after(dedup.bytes_hashed - hashed)
                 else:
-                    try:
-                        with ZipFile(file, 'r') as zipObj:
-                            for item in zipObj.namelist():
-                                item = item.lower()
+                    original = None
+
+                if original is None:
+                    yield file
+                elif original in results:
+                    finish((results[original] or ScanResult(original, [], None, [], {}))._replace(path=file))
+                else:
+                    copies.setdefault(original, []).append(file)
+
+        for result in scan_archives(candidates(), args.workers, args.max_depth, args.memory_cap, args.rule_set):
+            if throttle:
+                throttle.after(result.bytes_read, result.elapsed)
+
+            stats.record(result)
+            finish(result)
+
+            # any archive may turn out to have copies later on (most have nothing to report, which is kept cheaply)
+            if dedup is not None:
+                results[result.path] = result if result.items or result.error or result.skipped else None
+
+            for copy in copies.pop(result.path, ()):
+                finish(result._replace(path=copy))
 
-                                if "springframework" in item:
-                                    print(f"{file}::{item}")
-                    except:
-                        pass
+        drain_walk_errors()
 
-                    # with tempfile.TemporaryDirectory(dir=root_tmpdir) as unpack_tmpdir:
+    if cache is not None:
+        for file in cache.pop_deleted(drives):
+            reporter.deleted(file)
+
+    snapshot = stats.snapshot()
+    extra = {}
+    lines = [f"scanned: {snapshot['files_walked']} files walked, {snapshot['archives_opened']} archives opened "
+             f"({snapshot['bytes_read'] / 1048576:.1f} MiB read) in {snapshot['elapsed']:.1f}s, "
+             f"{snapshot['errors']} failed"]
+
+    if dedup is not None:
+        extra["dedup"] = dedup.stats()
+        lines.append(dedup.summary())
+
+    if throttle:
+        extra["throttle"] = {"waited": round(throttle.slept, 3)}
+        lines.append(f"throttle: {throttle.slept:.1f}s spent waiting")
+
+    if cache is not None:
+        extra["cache"] = {"unchanged": cache.hits, "changed": cache.misses}
+        lines.append(f"cache: {cache.hits} archives unchanged, {cache.misses} new or changed")
+        cache.close()
+
+    reporter.summary(extra, lines)
 
 
 if __name__ == '__main__':
-    if platform.system() == "Windows":
-        lower_priority()
+    args = parse_args()
+    lower_priority(args.priority)
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        main(tmpdir)
+    main(args)
         
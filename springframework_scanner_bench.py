@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Benchmark harness for springframework_scanner.
+#
+# Generates a synthetic directory tree (filler files, plain jars and wars, Spring Boot style fat jars with nested
+# libraries, and duplicate copies of all of those), then times the walk phase and the inspect phase separately and
+# runs the scanner end to end in a fresh interpreter to get its peak RSS.  Results are emitted as JSON so runs can be
+# compared across scanner changes.
+
+# Standard Library
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# make sure the scanner next to this file is the one benchmarked
+SCANNER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCANNER_DIR)
+
+import springframework_scanner as scanner  # noqa: E402
+
+# what a fraction of the generated archives contain, so the scanner has findings to report
+SPRING_ENTRY = "org/springframework/core/SpringVersion.class"
+SPRING_FRACTION = 0.1
+
+# libraries nested inside each fat jar, and how big the filler files are
+NESTED_LIBRARIES = 8
+FILLER_SIZE = 512
+
+
+def get_entry_names(rng, count):
+    # class-file-like entry names, spread over a few packages
+    return ["com/example/pkg%d/Class%d.class" % (rng.randrange(max(count // 50, 1)), index) for index in range(count)]
+
+
+def build_archive(rng, entries, nested=(), spring=False, compression=zipfile.ZIP_DEFLATED):
+    # the bytes of a zip archive with the given entries (and nested archives, stored uncompressed as Spring Boot does)
+    buffer = io.BytesIO()
+
+    with zipfile.ZipFile(buffer, 'w', compression) as archive:
+        archive.writestr("META-INF/MANIFEST.MF", "Manifest-Version: 1.0\nImplementation-Version: 1.0.%d\n"
+                         % rng.randrange(100))
+
+        for name in get_entry_names(rng, entries):
+            archive.writestr(name, b"\xca\xfe\xba\xbe")
+
+        if spring:
+            archive.writestr(SPRING_ENTRY, b"\xca\xfe\xba\xbe")
+
+        for name, data in nested:
+            archive.writestr(zipfile.ZipInfo(name), data, compress_type=zipfile.ZIP_STORED)
+
+    return buffer.getvalue()
+
+
+def get_directories(root, depth, fanout):
+    # every directory of a tree fanout wide and depth deep below root
+    directories = [root]
+    level = [root]
+
+    for _ in range(depth):
+        level = [os.path.join(parent, "d%d" % index) for parent in level for index in range(fanout)]
+        directories.extend(level)
+
+    return directories
+
+
+def generate_tree(root, args):
+    # write the synthetic tree; returns a description of what's in it
+    rng = random.Random(args.seed)
+    directories = get_directories(root, args.depth, args.fanout)
+
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    def place(name, data):
+        path = os.path.join(rng.choice(directories), name)
+
+        with open(path, 'wb') as output:
+            output.write(data)
+
+        return path
+
+    for index in range(args.files):
+        place("file%d.%s" % (index, rng.choice(["txt", "class", "xml", "properties", "so"])), b"x" * FILLER_SIZE)
+
+    originals = []
+
+    for index in range(args.jars):
+        data = build_archive(rng, args.entries, spring=rng.random() < SPRING_FRACTION)
+        originals.append(place("lib%d.jar" % index, data))
+
+    for index in range(args.wars):
+        data = build_archive(rng, args.entries, spring=rng.random() < SPRING_FRACTION)
+        originals.append(place("app%d.war" % index, data))
+
+    for index in range(args.fat_jars):
+        nested = [
+            ("BOOT-INF/lib/dependency%d-1.%d.jar" % (library, index),
+             build_archive(rng, args.entries // NESTED_LIBRARIES + 1, spring=library == 0))
+            for library in range(NESTED_LIBRARIES)
+        ]
+        originals.append(place("service%d.jar" % index, build_archive(rng, args.entries // 10 + 1, nested)))
+
+    # byte-for-byte copies of existing archives, as left behind by per-app copies and container layers
+    for index in range(args.duplicates if originals else 0):
+        source = rng.choice(originals)
+        shutil.copyfile(source, os.path.join(rng.choice(directories), "copy%d-%s" % (index, os.path.basename(source))))
+
+    return {
+        'directories': len(directories),
+        'files': args.files,
+        'jars': args.jars,
+        'wars': args.wars,
+        'fat_jars': args.fat_jars,
+        'duplicates': args.duplicates if originals else 0,
+        'entries_per_archive': args.entries,
+        'bytes': sum(os.path.getsize(os.path.join(directory, name))
+                     for directory, _, names in os.walk(root) for name in names),
+    }
+
+
+def measure_walk(root, walkers, runs):
+    # time listing the tree (and filtering it down to archives) on its own
+    samples = []
+
+    for _ in range(runs):
+        walker = scanner.TreeWalker(threads=walkers)
+        started = time.perf_counter()
+        archives = list(scanner.walk_tree(root, walker))
+        samples.append(time.perf_counter() - started)
+
+    best = min(samples)
+
+    return archives, {
+        'walkers': walkers,
+        'seconds': best,
+        'runs': runs,
+        'entries': walker.entries_walked,
+        'archives': len(archives),
+        'files_per_second': round(walker.entries_walked / best, 1),
+    }
+
+
+def measure_inspect(archives, workers, runs):
+    # time opening every archive (no walk, no dedup, no cache) with a given number of worker processes
+    samples = []
+
+    for _ in range(runs):
+        started = time.perf_counter()
+        results = list(scanner.scan_archives(archives, workers))
+        samples.append(time.perf_counter() - started)
+
+    best = min(samples)
+    bytes_read = sum(result.bytes_read for result in results)
+
+    return {
+        'workers': workers,
+        'seconds': best,
+        'runs': runs,
+        'archives': len(results),
+        'findings': sum(len(result.items) for result in results),
+        'archives_per_second': round(len(results) / best, 1),
+        'bytes_read': bytes_read,
+        'mib_per_second': round(bytes_read / best / 1048576, 1),
+    }
+
+
+def measure_end_to_end(root, scanner_args):
+    # the whole scanner in a fresh interpreter, reporting its own peak RSS and its workers' (in KiB, as Linux does)
+    code = (
+        "import resource, runpy, sys\n"
+        "sys.argv = %r\n"
+        "try:\n"
+        "    runpy.run_path(%r, run_name='__main__')\n"
+        "finally:\n"
+        "    sys.stderr.write('\\nRSS %%d %%d\\n' %% (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,\n"
+        "                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))\n"
+    ) % ([os.path.join(SCANNER_DIR, "springframework_scanner.py"), root, "--json", "--priority", "normal"]
+         + scanner_args, os.path.join(SCANNER_DIR, "springframework_scanner.py"))
+
+    started = time.perf_counter()
+
+    if resource is None:
+        subprocess.run([sys.executable, os.path.join(SCANNER_DIR, "springframework_scanner.py"), root, "--json",
+                        "--priority", "normal"] + scanner_args, check=True, stdout=subprocess.PIPE,
+                       universal_newlines=True)
+        return {'args': scanner_args, 'seconds': time.perf_counter() - started}
+
+    result = subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    elapsed = time.perf_counter() - started
+    rss = [line for line in result.stderr.splitlines() if line.startswith("RSS ")][-1].split()
+    summary = json.loads(result.stdout.strip().splitlines()[-1])
+
+    return {
+        'args': scanner_args,
+        'seconds': elapsed,
+        'peak_rss_kib': int(rss[1]),
+        'peak_worker_rss_kib': int(rss[2]),
+        'archives_opened': summary['archives_opened'],
+        'findings': summary['findings'],
+        'dedup': summary.get('dedup'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark springframework_scanner on a synthetic directory tree")
+    parser.add_argument('--files', type=int, default=20000, help='filler (non-archive) files (default: 20000)')
+    parser.add_argument('--depth', type=int, default=4, help='directory levels (default: 4)')
+    parser.add_argument('--fanout', type=int, default=5, help='sub-directories per directory (default: 5)')
+    parser.add_argument('--jars', type=int, default=500, help='plain jars (default: 500)')
+    parser.add_argument('--wars', type=int, default=50, help='wars (default: 50)')
+    parser.add_argument('--fat-jars', type=int, default=20,
+                        help='Spring Boot style jars with %d nested libraries each (default: 20)' % NESTED_LIBRARIES)
+    parser.add_argument('--entries', type=int, default=2000, help='entries per archive (default: 2000)')
+    parser.add_argument('--duplicates', type=int, default=500, help='copies of generated archives (default: 500)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, so trees can be regenerated exactly')
+    parser.add_argument('--tree', help='generate the tree here and keep it (or reuse it, if it already exists)')
+    parser.add_argument('--walkers', type=int, action='append', help='walker threads to time (may be repeated)')
+    parser.add_argument('--workers', type=int, action='append', help='worker processes to time (may be repeated)')
+    parser.add_argument('--runs', type=int, default=3, help='repetitions per phase measurement (best is reported)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scanner': scanner.__file__,
+    }
+
+    directory = args.tree or tempfile.mkdtemp(prefix="scanner-bench-")
+
+    try:
+        if args.tree and os.path.isdir(args.tree) and os.listdir(args.tree):
+            report['tree'] = {'reused': args.tree}
+        else:
+            started = time.perf_counter()
+            report['tree'] = generate_tree(directory, args)
+            report['tree']['generate_seconds'] = time.perf_counter() - started
+
+        report['walk'] = []
+
+        for walkers in args.walkers or [1, 4]:
+            archives, walk = measure_walk(directory, walkers, args.runs)
+            report['walk'].append(walk)
+
+        # the inspect phase gets the archives the walk found, so it measures opening them and nothing else
+        report['inspect'] = [measure_inspect(archives, workers, args.runs) for workers in args.workers or [1, 4]]
+
+        report['end_to_end'] = [
+            measure_end_to_end(directory, []),
+            measure_end_to_end(directory, ["--dedup"]),
+            measure_end_to_end(directory, ["-w", str(max(args.workers or [4]))]),
+        ]
+    finally:
+        if not args.tree:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()